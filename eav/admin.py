@@ -18,20 +18,185 @@
 #    You should have received a copy of the GNU Lesser General Public License
 #    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
 
-__all__ = ['BaseEntityAdmin', 'BaseSchemaAdmin', 'BaseEntityStackedInline']
+__all__ = ['BaseEntityAdmin', 'BaseSchemaAdmin', 'BaseEntityStackedInline',
+           'AttrColumn', 'AttrFilterSpec']
 
 
 # django
 from django.contrib.admin import helpers
+from django.contrib.admin.filterspecs import FilterSpec
 from django.contrib.admin.options import (
-    ModelAdmin, InlineModelAdmin, StackedInline
+    ModelAdmin, InlineModelAdmin, StackedInline, IncorrectLookupParameters
 )
+from django.contrib.admin.views.main import ChangeList, EMPTY_CHANGELIST_VALUE
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count
 from django.forms.models import BaseInlineFormSet
+from django.utils.encoding import smart_str, smart_unicode
 from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext as _
+
+# this app
+from managers import RANGE_LOOKUPS, EavQ
+from registry import registry
+
+
+class AttrColumn(object):
+    """
+    A changelist column which displays the value of an EAV attribute. Usage::
+
+        class ProductAdmin(BaseEntityAdmin):
+            list_display = ('title', AttrColumn('colour'), AttrColumn('size'))
+
+    Attributes of all entities on a changelist page are loaded with a single
+    query (see `EntityChangeList`).
+    """
+    def __init__(self, name, short_description=None):
+        self.name = self.__name__ = name
+        self.short_description = (short_description or
+                                  name.replace('_', ' ').capitalize())
+
+    def __call__(self, entity):
+        value = getattr(entity, self.name)
+        if isinstance(value, list):
+            value = u', '.join(smart_unicode(x) for x in value)
+        if value is None or value == u'':
+            return EMPTY_CHANGELIST_VALUE
+        return value
+
+
+class AttrFilterSpec(FilterSpec):
+    """
+    Changelist filter by an EAV attribute. Values are collected from all
+    entities of the changelist with a single grouped query and displayed
+    along with the number of entities which have them.
+    """
+    def __init__(self, schema, request, params, model, model_admin):
+        super(AttrFilterSpec, self).__init__(schema, request, params, model,
+                                             model_admin)
+        if schema.datatype == schema.TYPE_RANGE:
+            raise ImproperlyConfigured('Cannot filter changelist by range '
+                                       'attribute "%s".' % schema.name)
+        self.schema = schema
+        self.lookup_kwarg = schema.name
+        self.lookup_val = request.GET.get(self.lookup_kwarg, None)
+        self.lookup_choices = self._get_lookup_choices(
+            model_admin.queryset(request))
+
+    def _get_lookup_choices(self, queryset):
+        # returns a list of (value, label, count) tuples
+        schema = self.schema
+        ctype = ContentType.objects.get_for_model(queryset.model)
+        if schema.datatype == schema.TYPE_MANY:
+            field_names = ['choice', 'choice__title']
+        else:
+            field_names = ['value_%s' % schema.datatype]
+        rows = schema.value_attrs.filter(**{
+            'entity_type': ctype,
+            'entity_id__in': queryset.order_by().values('pk'),
+            '%s__isnull' % field_names[0]: False,
+        })
+        rows = rows.order_by(field_names[-1]).values_list(*field_names)
+        choices = []
+        for row in rows.annotate(count=Count('entity_id')):
+            value, label, count = row[0], row[-2], row[-1]
+            if schema.datatype == schema.TYPE_BOOLEAN:
+                value, label = ('1', _('Yes')) if value else ('0', _('No'))
+            choices.append((smart_unicode(value), smart_unicode(label), count))
+        return choices
+
+    def has_output(self):
+        return bool(self.lookup_choices)
+
+    def title(self):
+        return self.schema.title
+
+    def choices(self, cl):
+        yield {'selected': self.lookup_val is None,
+               'query_string': cl.get_query_string({}, [self.lookup_kwarg]),
+               'display': _('All')}
+        for value, label, count in self.lookup_choices:
+            yield {'selected': self.lookup_val == value,
+                   'query_string': cl.get_query_string({self.lookup_kwarg: value}),
+                   'display': u'%s (%d)' % (label, count)}
+
+
+class EntityChangeList(ChangeList):
+    """
+    Changelist which understands `AttrColumn` and `eav_list_filter` of
+    `BaseEntityAdmin`.
+    """
+    def get_query_set(self):
+        # EAV lookups are hidden from the standard machinery (which only
+        # knows model fields) and applied separately; those which are not
+        # allowed are ignored
+        names = self.model_admin.eav_list_filter
+        params = self.params
+        eav_lookups = dict((smart_str(k), v) for k, v in params.items()
+                           if k.split('__')[0] in names and
+                           self.model_admin.eav_lookup_allowed(k))
+        self.params = dict((k, v) for k, v in params.items()
+                           if k.split('__')[0] not in names)
+        try:
+            qs = super(EntityChangeList, self).get_query_set()
+        finally:
+            self.params = params
+        if eav_lookups:
+            try:
+                qs = qs.filter(EavQ(**eav_lookups))
+            except (NameError, TypeError, ValueError):
+                raise IncorrectLookupParameters
+        return qs
+
+    def get_results(self, request):
+        super(EntityChangeList, self).get_results(request)
+        has_columns = any(isinstance(x, AttrColumn) for x in self.list_display)
+        if has_columns and hasattr(self.result_list, 'with_attrs'):
+            self.result_list = self.result_list.with_attrs()
+
+    def get_filters(self, request):
+        specs, has_filters = super(EntityChangeList, self).get_filters(request)
+        schemata = registry.get_schemata_dict(self.model)
+        for name in self.model_admin.eav_list_filter:
+            if name not in schemata:
+                # e.g. the schema was deleted or renamed
+                continue
+            spec = AttrFilterSpec(schemata[name], request, self.params,
+                                  self.model, self.model_admin)
+            if spec.has_output():
+                specs.append(spec)
+        return specs, bool(specs)
 
 
 class BaseEntityAdmin(ModelAdmin):
 
+    # names of EAV attributes to filter the changelist by; use `AttrColumn`
+    # to display attributes in `list_display`
+    eav_list_filter = ()
+
+    # lookups which may be applied to attributes from `eav_list_filter`
+    # via the query string (range attributes also allow their own lookups)
+    eav_lookups = ('exact', 'in', 'range')
+
+    def get_changelist(self, request, **kwargs):
+        return EntityChangeList
+
+    def eav_lookup_allowed(self, lookup):
+        """
+        Returns True if the changelist may be filtered by given lookup of an
+        EAV attribute, e.g. "colour" or "size__in". Like
+        `ModelAdmin.lookup_allowed()`, but for attributes.
+        """
+        schemata = registry.get_schemata_dict(self.model)
+        name, sep, sublookup = lookup.partition('__')
+        if name not in self.eav_list_filter or name not in schemata:
+            return False
+        allowed = tuple(self.eav_lookups)
+        if schemata[name].datatype == schemata[name].TYPE_RANGE:
+            allowed += RANGE_LOOKUPS
+        return not sublookup or sublookup in allowed
+
     def render_change_form(self, request, context, **kwargs):
         """
         Wrapper for ModelAdmin.render_change_form. Replaces standard static
@@ -63,11 +228,33 @@ class BaseSchemaAdmin(ModelAdmin):
 
 class BaseEntityInlineFormSet(BaseInlineFormSet):
     """
-    An inline formset that correctly initializes EAV forms.
+    An inline formset that correctly initializes EAV forms. Attributes of all
+    existing inline entities are loaded with a single query, and form fields
+    are built once per set of schemata and shared by all forms.
     """
+    def __init__(self, *args, **kwargs):
+        # set of schemata --> form fields (see `BaseDynamicEntityForm`)
+        self._dynamic_fields = {}
+        super(BaseEntityInlineFormSet, self).__init__(*args, **kwargs)
+
+    def get_queryset(self):
+        qs = super(BaseEntityInlineFormSet, self).get_queryset()
+        if hasattr(qs, 'with_attrs') and not qs._prefetch_attrs:
+            qs = self._queryset = qs.with_attrs()
+        return qs
+
+    def _construct_form(self, i, **kwargs):
+        kwargs['dynamic_fields'] = self._dynamic_fields
+        return super(BaseEntityInlineFormSet, self)._construct_form(i, **kwargs)
+
     def add_fields(self, form, index):
-        if self.instance:
-            setattr(form.instance, self.fk.name, self.instance)
+        # existing entities already know the parent, so their fields are
+        # built correctly by the form itself
+        if self.instance and form.instance.pk is None:
+            instance = form.instance
+            setattr(instance, self.fk.name, self.instance)
+            # schemata may depend on the parent
+            instance._cache_schemata(registry.get_queryset(type(instance)))
             form._build_dynamic_fields()
         super(BaseEntityInlineFormSet, self).add_fields(form, index)
 
@@ -98,6 +285,6 @@ class BaseEntityInline(InlineModelAdmin):
         fk_name = self.fk_name or formset.fk.name
         kw = {fk_name: obj} if obj else {}
         instance = self.model(**kw)
-        form = formset.form(request.POST, instance=instance)
+        fields = formset.form.get_field_names(instance)
 
-        return [(None, {'fields': form.fields.keys()})]
+        return [(None, {'fields': fields})]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Benchmarks for the core EAV operations. A synthetic catalog is generated with
+the models from `eav.tests` (see `eav.benchmarks.catalog`), then filtering,
+saving, reading attributes, faceting and sorting are timed and their queries
+are counted (see `eav.benchmarks.runner`).
+
+As the models only exist in the test database, the benchmarks are normally run
+with the management command which creates and destroys it::
+
+    ./manage.py benchmark_eav --entities=5000 --schemata=20 --output=report.json
+    ./manage.py benchmark_eav --compare=report.json
+
+The report is a JSON document; reports made for different commits (or
+backends) can be compared with `--compare`. An SQLite database is sufficient.
+"""
+
+from runner import compare_reports, run_benchmarks
+
+
+__all__ = ['compare_reports', 'run_benchmarks']
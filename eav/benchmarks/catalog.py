@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Generator of synthetic catalogs: a number of schemata of all datatypes and a
+number of entities with random (but reproducible) values of attributes.
+"""
+
+# python
+from datetime import date, timedelta
+import random
+
+# this app
+from eav.tests import Entity, Schema
+
+
+__all__ = ['CatalogGenerator']
+
+
+DATATYPES = (Schema.TYPE_TEXT, Schema.TYPE_FLOAT, Schema.TYPE_MANY,
+             Schema.TYPE_DATE, Schema.TYPE_BOOLEAN, Schema.TYPE_RANGE)
+
+
+class CatalogGenerator(object):
+    """
+    Creates schemata and entities of the test models. Usage::
+
+        catalog = CatalogGenerator(entities=1000, schemata=10, choices=5)
+        catalog.generate()
+        Entity.objects.create(title='foo', **catalog.make_values())
+
+    :param entities: number of entities.
+    :param schemata: number of schemata; datatypes are assigned in turn.
+    :param choices: number of distinct values (or choices) per schema.
+    :param density: probability of an entity to have a given attribute.
+    :param seed: seed for the random values.
+    """
+    def __init__(self, entities=1000, schemata=10, choices=5, density=0.9,
+                 seed=0):
+        self.entities = entities
+        self.schemata = schemata
+        self.choices = choices
+        self.density = density
+        self.random = random.Random(seed)
+        self.schema_list = []
+        self._choices = {}
+
+    def generate(self, batch_size=500):
+        "Creates schemata and entities."
+        for i in range(self.schemata):
+            datatype = DATATYPES[i % len(DATATYPES)]
+            schema = Schema.objects.create(
+                title='Bench %d' % i, name='bench_%d' % i, datatype=datatype,
+                filtered=True, sortable=datatype != Schema.TYPE_MANY)
+            if datatype == Schema.TYPE_MANY:
+                self._choices[schema.pk] = [
+                    schema.choices.create(title='choice %d' % j)
+                    for j in range(self.choices)]
+            self.schema_list.append(schema)
+        rows = [dict(self.make_values(), title='Item %d' % i,
+                     price=self.random.randint(1, 1000))
+                for i in range(self.entities)]
+        Entity.objects.bulk_create_with_attrs(rows, batch_size=batch_size)
+
+    def get_schema(self, datatype):
+        "Returns the first generated schema of given datatype."
+        for schema in self.schema_list:
+            if schema.datatype == datatype:
+                return schema
+        raise ValueError('No schema of type "%s" was generated.' % datatype)
+
+    def make_values(self):
+        "Returns random attribute values keyed by schema name."
+        values = {}
+        for schema in self.schema_list:
+            if self.random.random() < self.density:
+                values[schema.name] = self.make_value(schema)
+        return values
+
+    def make_value(self, schema):
+        "Returns a random value for given schema."
+        rand = self.random
+        n = rand.randrange(self.choices)
+        if schema.datatype == Schema.TYPE_TEXT:
+            return u'value %d' % n
+        if schema.datatype == Schema.TYPE_FLOAT:
+            return float(n)
+        if schema.datatype == Schema.TYPE_DATE:
+            return date(2010, 1, 1) + timedelta(days=n)
+        if schema.datatype == Schema.TYPE_BOOLEAN:
+            return bool(n % 2)
+        if schema.datatype == Schema.TYPE_MANY:
+            choices = self._choices[schema.pk]
+            return rand.sample(choices, rand.randint(1, min(3, len(choices))))
+        if schema.datatype == Schema.TYPE_RANGE:
+            return (float(n), float(n + rand.randint(1, 10)))
+        raise ValueError('Unknown datatype "%s".' % schema.datatype)
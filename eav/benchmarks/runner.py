@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Timing of the core EAV operations against a generated catalog.
+"""
+
+# python
+import time
+
+# django
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.utils.datastructures import SortedDict
+
+# this app
+from eav.benchmarks.catalog import CatalogGenerator
+from eav.tests import Entity, FacetSet, Schema
+
+
+__all__ = ['BenchmarkRunner', 'run_benchmarks', 'compare_reports']
+
+
+class BenchmarkRunner(object):
+    """
+    Runs given functions several times and records the wall time and the
+    number of queries. Queries are only logged by Django with `DEBUG` turned
+    on, so it is enabled while the runner is in use; note that logging adds
+    a little overhead to the timings.
+    """
+    def __init__(self, repeat=3):
+        self.repeat = repeat
+        self.results = SortedDict()
+
+    def measure(self, name, func):
+        """
+        Calls `func` `repeat` times and stores its minimum and mean time (in
+        seconds) and the number of queries made by the first call.
+        """
+        times = []
+        queries = None
+        for i in range(self.repeat):
+            reset_queries()
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+            if queries is None:
+                queries = len(connection.queries)
+        self.results[name] = {
+            'min': min(times),
+            'mean': sum(times) / len(times),
+            'queries': queries,
+        }
+
+
+def run_benchmarks(entities=1000, schemata=10, choices=5, repeat=3, seed=0):
+    """
+    Generates a catalog in the current database and times the core operations
+    against it. Returns a JSON-compatible report. See `CatalogGenerator` for
+    the parameters.
+    """
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    try:
+        catalog = CatalogGenerator(entities=entities, schemata=schemata,
+                                   choices=choices, seed=seed)
+        start = time.time()
+        catalog.generate()
+        generated = time.time() - start
+
+        runner = BenchmarkRunner(repeat=repeat)
+        _run(runner, catalog)
+    finally:
+        settings.DEBUG = debug
+    return {
+        'backend': connection.settings_dict['ENGINE'],
+        'params': {'entities': entities, 'schemata': schemata,
+                   'choices': choices, 'repeat': repeat, 'seed': seed},
+        'generated': generated,
+        'results': runner.results,
+    }
+
+
+def _run(runner, catalog):
+    text = catalog.get_schema(Schema.TYPE_TEXT).name
+    number = catalog.get_schema(Schema.TYPE_FLOAT).name
+    names = [s.name for s in catalog.schema_list]
+    value = catalog.make_value(catalog.get_schema(Schema.TYPE_TEXT))
+    pk = Entity.objects.order_by('pk')[0].pk
+
+    def create():
+        Entity.objects.create(title='New', **catalog.make_values())
+
+    def save():
+        entity = Entity.objects.get(pk=pk)
+        for name, value in catalog.make_values().items():
+            setattr(entity, name, value)
+        entity.save()
+
+    def read_attrs(qs):
+        for entity in qs[:50]:
+            for name in names:
+                getattr(entity, name)
+
+    runner.measure('create', create)
+    runner.measure('save', save)
+    runner.measure('filter', lambda: list(Entity.objects.filter(**{text: value})))
+    runner.measure('filter_range', lambda: list(
+        Entity.objects.filter(**{'%s__gte' % number: 1, '%s__lte' % number: 3})))
+    runner.measure('exclude', lambda: list(Entity.objects.exclude(**{text: value})))
+    runner.measure('read_attrs', lambda: read_attrs(Entity.objects.all()))
+    runner.measure('read_attrs_prefetched',
+                   lambda: read_attrs(Entity.objects.with_attrs()))
+    runner.measure('facet_object_list',
+                   lambda: list(FacetSet({text: value}).object_list))
+    runner.measure('facet_form', lambda: unicode(FacetSet({}).form))
+    runner.measure('sort_by_attribute', lambda: list(
+        FacetSet({'order_by': number}).object_list[:50]))
+
+
+def compare_reports(old, new):
+    """
+    Returns a list of (name, old time, new time, ratio, old queries, new
+    queries) tuples for benchmarks found in both given reports. Mean times
+    are compared; ratio above 1 means that the operation became slower.
+    """
+    rows = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        ratio = result['mean'] / before['mean'] if before['mean'] else None
+        rows.append((name, before['mean'], result['mean'], ratio,
+                     before['queries'], result['queries']))
+    return rows
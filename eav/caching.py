@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Caching of facet choices. Lists of choices are stored via Django cache
+framework for a limited time and are keyed by schema and by the scope, i.e.
+the query which selects entities the choices are collected from. Each schema
+has a version number which is changed whenever attributes or choices of the
+schema are saved, so cached lists are invalidated in all processes at once.
+
+The cache is used by `eav.facets.BaseFacetSet` via its `choice_cache`
+attribute, which can be set to another `ChoiceCache` instance (e.g. with a
+different timeout) or to None to disable caching::
+
+    class ProductFacetSet(BaseFacetSet):
+        choice_cache = ChoiceCache(timeout=60)
+
+Note that `QuerySet.update()` does not send any signals, so the cache must be
+invalidated manually in such cases::
+
+    from eav.caching import invalidate_choices
+    invalidate_choices(schema.pk)
+
+"""
+
+# python
+from hashlib import md5
+import time
+
+# django
+from django.core.cache import cache
+
+
+__all__ = ['ChoiceCache', 'invalidate_choices']
+
+
+VERSION_KEY = 'eav_choices_version:%s'
+
+
+def get_choices_version(schema_id):
+    "Returns current version of cached choices for given schema."
+    key = VERSION_KEY % schema_id
+    version = cache.get(key)
+    if version is None:
+        # use current time so that the number never goes back if the key is
+        # evicted from the cache
+        cache.add(key, int(time.time() * 1000))
+        version = cache.get(key)
+    return version
+
+
+def invalidate_choices(schema_id):
+    "Drops cached choices for given schema in all processes."
+    try:
+        cache.incr(VERSION_KEY % schema_id)
+    except ValueError:
+        # the key is missing, it will be set on next access
+        pass
+
+
+class ChoiceCache(object):
+
+    key_prefix = 'eav_choices'
+
+    def __init__(self, timeout=300):
+        self.timeout = timeout
+
+    def get_key(self, schema, scope):
+        version = get_choices_version(schema.pk)
+        scope = md5(unicode(scope).encode('utf-8')).hexdigest()
+        return '%s:%s:%s:%s' % (self.key_prefix, schema.pk, version, scope)
+
+    def get_or_set(self, schema, scope, func):
+        """
+        Returns cached value for given schema and scope. If the value is not
+        cached yet, it is obtained by calling `func` and stored in the cache.
+        """
+        key = self.get_key(schema, scope)
+        value = cache.get(key)
+        if value is None:
+            value = func()
+            cache.set(key, value, self.timeout)
+        return value
@@ -22,10 +22,15 @@
 #       The thing works well as it is but the client code could be more readable.
 
 # python
+from hashlib import md5
 from itertools import chain
 
 # django
-from django.db import models
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connections, models
+from django.db.models import Count
+from django.db.models.query import EmptyQuerySet
 from django import forms
 from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext as _
@@ -34,7 +39,18 @@ from django.utils.translation import ugettext as _
 from view_shortcuts.decorators import cached_property
 
 # this app
+from caching import ChoiceCache
 from fields import RangeField
+from instrumentation import track
+from registry import registry
+
+
+# maximum number of cached form classes; the cache is simply dropped when it
+# grows too large
+FORM_CACHE_SIZE = 200
+
+# (facet set class, schemata version, facet keys) --> form class
+_form_classes = {}
 
 
 class Facet(object):
@@ -73,6 +89,15 @@ class Facet(object):
         defaults.update(self.extra)
         return self.field_class(**defaults)
 
+    def get_form_field_key(self):
+        """
+        Returns a hashable value which identifies the form field of this facet
+        along with the schemata version, so that the field can be reused by
+        other instances of the facet set. Returns None if the field cannot be
+        reused.
+        """
+        return (type(self), self.attr_name, self.lookup_prefix)
+
     @property
     def attr_name(self):
         "Returns attribute name for this facet"
@@ -86,6 +111,55 @@ class Facet(object):
         "Returns dictionary of lookups for facet-specific query."
         return {self.lookup_name: value} if value else {}
 
+    # True if it makes sense to count entities per value (see `get_counts()`)
+    has_counts = False
+
+    def get_counts(self, queryset=None):
+        """
+        Returns a dictionary of values of this facet mapped to numbers of
+        entities which have them. Entities are taken from given queryset
+        (defaults to facet set's `object_list`). Makes a single grouped query.
+        Many-to-one values are represented by primary keys of choices.
+        """
+        qs = self.facet_set.object_list if queryset is None else queryset
+        if isinstance(qs, EmptyQuerySet):
+            return {}
+        rows, field_name = self._get_value_rows(qs)
+        count_field = 'entity_id' if self.schema else 'pk'
+        rows = rows.order_by().values(field_name).annotate(count=Count(count_field))
+        return dict((x[field_name], x['count']) for x in rows)
+
+    def _get_value_rows(self, qs):
+        """
+        Returns a queryset of rows which hold values of this facet for given
+        entities, and the name of the value field. For a schema these are
+        non-empty attributes of the entities (selected with a subquery).
+        """
+        if not self.schema:
+            return qs, self.lookup_name
+        model = self._get_entity_model(qs.model)
+        ctype = ContentType.objects.get_for_model(model)
+        entities = qs.order_by().values('%spk' % self.lookup_prefix)
+        if self.schema.datatype == self.schema.TYPE_MANY:
+            field_name = 'choice'
+        else:
+            field_name = 'value_%s' % self.schema.datatype
+        rows = self.schema.value_attrs.filter(**{
+            'entity_type': ctype,
+            'entity_id__in': entities,
+            '%s__isnull' % field_name: False,
+        })
+        return rows, field_name
+
+    def _get_entity_model(self, model):
+        # follows the lookup prefix (e.g. "product__") to the model which
+        # owns the schema's attributes
+        for name in self.lookup_prefix.split('__'):
+            if name:
+                field = model._meta.get_field_by_name(name)[0]
+                model = field.rel.to if getattr(field, 'rel', None) else field.model
+        return model
+
 
 class TextFacet(Facet):
     """
@@ -100,28 +174,66 @@ class TextFacet(Facet):
         is used.
     """
     field_class = forms.ChoiceField
+    has_counts = True
+    has_blank_choice = True
 
     def __init__(self, *args, **kwargs):
         self.max_radio_choices = kwargs.pop('max_radio_choices', 5)
         super(TextFacet, self).__init__(*args, **kwargs)
 
-    def _get_choices(self, blank=False):
-        if self.schema:
-            # FIXME implementation details exposed ###########
-            # FIXME in some cases (e.g. shop) we don't need *all* attrs, it
-            #       would be better to fine-filter them (e.g. by rubric).
-            attrs = self.schema.attrs.all()
-            field_name = 'value_%s' % self.schema.datatype
+    @track('choices')
+    def _get_choices(self, blank=False, queryset=None):
+        """
+        Returns choices for values found among given entities (defaults to
+        all entities of the facet set's `get_queryset()`, so it can be used
+        to restrict the choices e.g. by rubric).
+        """
+        if queryset is None:
+            queryset = self.facet_set.get_queryset()
+
+        def get_values():
+            rows, field_name = self._get_value_rows(queryset)
+            values = rows.order_by().values_list(field_name, flat=True)
+            return sorted(values.distinct())
+
+        cache = self.facet_set.choice_cache
+        if cache and self.schema:
+            scope = '%s%s' % (self.lookup_prefix, queryset.query)
+            values = cache.get_or_set(self.schema, scope, get_values)
         else:
-            attrs = self.facet_set.get_queryset()
-            field_name = self.attr_name
-        choices = set(attrs.values_list(field_name, flat=True).distinct())
+            values = get_values()
         blank_choice = [('', _('any'))] if blank else []
-        return blank_choice + [(x,x) for x in choices]
+        return blank_choice + [(x,x) for x in values]
+
+    def get_form_field_key(self):
+        # choices are only identified if they are cached
+        cache = self.facet_set.choice_cache
+        if not (cache and self.schema):
+            return None
+        queryset = self.facet_set.get_queryset()
+        scope = '%s%s' % (self.lookup_prefix, queryset.query)
+        return (super(TextFacet, self).get_form_field_key(),
+                cache.get_key(self.schema, scope))
+
+    def narrow_choices(self, queryset):
+        """
+        Restricts choices of the form field to values found among given
+        entities. Currently selected values are kept.
+        """
+        form = self.facet_set.form
+        selected = form[self.attr_name].data
+        if not isinstance(selected, (list, tuple)):
+            selected = [selected]
+        choices = self._get_choices(blank=self.has_blank_choice,
+                                    queryset=queryset)
+        values = set(unicode(k) for k, v in choices)
+        choices.extend((x, x) for x in selected
+                       if x and unicode(x) not in values)
+        form.fields[self.attr_name].choices = choices
 
     @property
     def extra(self):
-        choices = self._get_choices(blank=True)
+        choices = self._get_choices(blank=self.has_blank_choice)
         d = {'choices': choices}
         if len(choices) < self.max_radio_choices:
             d['widget'] = forms.RadioSelect
@@ -134,10 +246,11 @@ class MultiTextFacet(TextFacet):
     """
     field_class = forms.MultipleChoiceField
     widget = forms.CheckboxSelectMultiple
+    has_blank_choice = False
 
     @property
     def extra(self):
-        choices = self._get_choices(blank=False)
+        choices = self._get_choices(blank=self.has_blank_choice)
         return {'choices': choices}
 
     def get_lookups(self, value):
@@ -146,6 +259,7 @@ class MultiTextFacet(TextFacet):
 
 class ManyToManyFacet(Facet):
     field_class = forms.models.ModelMultipleChoiceField
+    has_counts = True
 
     def _get_queryset(self):
         assert self.schema.datatype == self.schema.TYPE_MANY
@@ -159,6 +273,28 @@ class ManyToManyFacet(Facet):
             'widget': forms.CheckboxSelectMultiple,
         }
 
+    @property
+    @track('choices')
+    def form_field(self):
+        field = super(ManyToManyFacet, self).form_field
+        cache = self.facet_set.choice_cache
+        if cache:
+            # the field can use a list of (pk, label) pairs instead of the
+            # queryset to display choices
+            field.cache_choices = True
+            field.choice_cache = cache.get_or_set(
+                self.schema, field.queryset.query,
+                lambda: [(x.pk, field.label_from_instance(x))
+                         for x in field.queryset])
+        return field
+
+    def get_form_field_key(self):
+        cache = self.facet_set.choice_cache
+        if not cache:
+            return None
+        return (super(ManyToManyFacet, self).get_form_field_key(),
+                cache.get_key(self.schema, self._get_queryset().query))
+
     def get_lookups(self, value):
         "Returns dictionary of lookups for facet-specific query."
         return {'%s__in' % self.lookup_name: value} if value else {}
@@ -191,9 +327,15 @@ class MultiRangeFacet(Facet):
     """
     field_class = RangeField
 
+    # how ranges are matched: "overlaps", "contains", "within" or "equals"
+    # (see `BaseEntityManager._filter_by_range_schema()`)
+    range_lookup = 'overlaps'
+
     def get_lookups(self, value):
         # we assume that this goes through the custom manager's filter()
-        return {self.lookup_name: value} if value else {}
+        if not value:
+            return {}
+        return {'%s__%s' % (self.lookup_name, self.range_lookup): value}
 
 
 class DateFacet(Facet):
@@ -202,6 +344,7 @@ class DateFacet(Facet):
 
 class BooleanFacet(Facet):
     field_class = forms.NullBooleanField
+    has_counts = True
 
     # XXX this is funny but using RadioSelect for booleans is non-trivial
     #widget = RadioSelect
@@ -229,6 +372,29 @@ class BaseFacetSet(object):
     sortable_fields = []
     custom_facets = {}
 
+    # cache for lists of choices (see `eav.caching`); None disables caching
+    choice_cache = ChoiceCache()
+
+    # how `count()` obtains the number of results: "exact" runs COUNT(*) once
+    # per facet set, "cached" keeps the number in Django cache for
+    # `count_timeout` seconds, "estimated" uses the query planner's estimate
+    # (PostgreSQL only, other backends fall back to "cached")
+    count_mode = 'exact'
+    count_timeout = 300
+
+    # where to put entities without the sort attribute: "first" or "last"
+    sort_nulls = 'last'
+
+    # if True, choices of text facets are restricted to values found among
+    # entities which match all *other* active facets (disjunctive faceting);
+    # otherwise all values found in `get_queryset()` are offered
+    narrow_choices = False
+
+    # name of the parameter with a full-text search query (see `eav.search`),
+    # e.g. "q"; None (default) disables search. `get_queryset()` must return
+    # an `EntityQuerySet` if search is enabled
+    search_param = None
+
     def __getitem__(self, k):
         return self.object_list[k]
 
@@ -239,9 +405,39 @@ class BaseFacetSet(object):
         return iter(self.object_list)
 
     def __len__(self):
-        if self.object_list:
-            return self.object_list.count()
-        return 0
+        return self.count()
+
+    def count(self):
+        "Returns the number of results. See `count_mode`."
+        if not hasattr(self, '_count'):
+            self._count = self._get_count()
+        return self._count
+
+    def _get_count(self):
+        qs = self.object_list
+        if isinstance(qs, EmptyQuerySet):
+            return 0
+        if self.count_mode == 'exact':
+            return qs.count()
+        if self.count_mode == 'estimated':
+            connection = connections[qs.db]
+            engine = connection.settings_dict['ENGINE']
+            if engine.split('.')[-1].startswith('postgresql'):
+                return self._get_estimated_count(connection, qs)
+        sql = unicode(qs.query).encode('utf-8')
+        key = 'eav_facet_count:%s' % md5(sql).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = qs.count()
+            cache.set(key, count, self.count_timeout)
+        return count
+
+    def _get_estimated_count(self, connection, qs):
+        sql, params = qs.query.get_compiler(connection=connection).as_sql()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN %s' % sql, params)
+        plan = cursor.fetchone()[0]
+        return int(plan.split(' rows=', 1)[1].split(' ', 1)[0])
 
     def get_queryset(self, **kwargs):
         raise NotImplementedError('BaseFacetSet subclasses must define get_queryset()')
@@ -292,15 +488,61 @@ class BaseFacetSet(object):
     def facets(self):
         return list(self._get_facets())
 
+    @cached_property
+    def facet_counts(self):
+        """
+        Returns numbers of matching entities per facet value keyed by facet
+        name, e.g. ``{'colour': {u'red': 3}, 'size': {1: 2, 2: 5}}``. Only
+        entities from `object_list` are counted (i.e. all active filters are
+        applied). Makes one query per text, boolean or many-to-one facet.
+        """
+        return dict((str(facet.attr_name), facet.get_counts())
+                    for facet in self.facets if facet.has_counts)
+
     @cached_property
     def form(self):
         if not hasattr(self, '_form'):
-            fields = SortedDict([(facet.attr_name, facet.form_field) for facet in self.facets])
-            class_name = '%sForm' % self.__class__.__name__   # XXX maybe add rubric slug?
-            FormClass = type(class_name, (forms.Form,), fields)
+            FormClass = self.get_form_class()
             self._form = FormClass(self.data)
+            if self.narrow_choices:
+                self._narrow_choices()
         return self._form
 
+    def get_form_class(self):
+        """
+        Returns the form class for facets. The class is shared between facet
+        sets of the same class with the same schemata and choices (see
+        `Facet.get_form_field_key()`); it is rebuilt when any of them changes.
+        """
+        keys = tuple(facet.get_form_field_key() for facet in self.facets)
+        if None in keys:
+            return self._build_form_class()
+        key = type(self), registry.version, keys
+        FormClass = _form_classes.get(key)
+        if FormClass is None:
+            FormClass = self._build_form_class()
+            if len(_form_classes) >= FORM_CACHE_SIZE:
+                _form_classes.clear()
+            _form_classes[key] = FormClass
+        return FormClass
+
+    def _build_form_class(self):
+        fields = SortedDict([(facet.attr_name, facet.form_field) for facet in self.facets])
+        class_name = '%sForm' % self.__class__.__name__   # XXX maybe add rubric slug?
+        return type(class_name, (forms.Form,), fields)
+
+    def _narrow_choices(self):
+        for facet in self.facets:
+            if not isinstance(facet, TextFacet):
+                continue
+            try:
+                lookups = self.get_lookups(exclude=facet)
+            except forms.ValidationError:
+                # the form will display errors anyway
+                return
+            lookups = dict((str(k),v) for k,v in lookups.items())
+            facet.narrow_choices(self.search(self.get_queryset(**lookups)))
+
     def get_field_and_lookup(self, name):
         """
         Returns field instance and lookup prefix for given attribute name.
@@ -315,9 +557,12 @@ class BaseFacetSet(object):
         lookup_prefix = ''
         return schema, lookup_prefix
 
-    def get_lookups(self):
+    def get_lookups(self, exclude=None):
+        "Returns lookups for all facets except given one."
         lookups = {}
         for facet in self.facets:
+            if facet is exclude:
+                continue
             data  = self.form[facet.attr_name].data
             field = self.form.fields[facet.attr_name]
             value = field.clean(data)
@@ -332,8 +577,9 @@ class BaseFacetSet(object):
             return self.get_queryset().none()
         lookups = dict((str(k),v) for k,v in lookups.items())
 
-        # assume to use the EntityManager's smart filter()
-        qs = self.get_queryset(**lookups).distinct()
+        # assume to use the EntityManager's smart filter(); EAV lookups are
+        # resolved with subqueries, so the results contain no duplicates
+        qs = self.search(self.get_queryset(**lookups))
 
         order_by_name = self.data.get('order_by')
         if order_by_name:
@@ -341,6 +587,30 @@ class BaseFacetSet(object):
         return qs
 
 
+    def search(self, qs):
+        """
+        Restricts given queryset to entities which match the search query
+        (if any). Assumes an `EntityQuerySet`.
+        """
+        query = self.search_param and self.data.get(self.search_param)
+        return qs.search(query) if query else qs
+
+    def get_sort_key(self):
+        """
+        Returns a tuple of SQL expression (with its params) for the value
+        results are sorted by, and True if the order is descending. The
+        expression is None if results are not sorted or are sorted by
+        a related object. Used by `eav.pagination.KeysetPaginator`.
+        """
+        name = self.data.get('order_by')
+        desc = bool(self.data.get('order_desc'))
+        if not name:
+            return None, [], False
+        qs = self.get_queryset()
+        sql, params = qs.model._default_manager.get_sort_expression(name,
+                                                                    using=qs.db)
+        return sql, params, desc
+
     def sort_by_attribute(self, qs, name):
         """
         A wrapper around standard order_by() method. Allows to sort by both normal
@@ -350,18 +620,23 @@ class BaseFacetSet(object):
             qs = sort_by_attributes(qs, 'price', 'colour')
 
         ...where `price` is a FloatField, and `colour` is the name of an EAV attribute
-        represented by Schema and Attr models.
+        represented by Schema and Attr models. Entities which lack the attribute
+        are placed according to `sort_nulls`.
         """
         fields   = self.get_queryset().model._meta.get_all_field_names()
         schemata = self.sortable_names
         direction = '-' if self.data.get('order_desc') else ''
         if name in fields:
-            return qs.order_by('%s%s' % (direction, name))
+            if not hasattr(qs, 'order_by_attrs'):
+                return qs.order_by('%s%s' % (direction, name))
+            # same placement of NULLs as for attributes (and in
+            # `eav.pagination.KeysetPaginator`)
+            return qs.order_by_attrs('%s%s' % (direction, name),
+                                     nulls=self.sort_nulls)
         elif name in schemata:
-            schema = self.get_schema(name)
-            value_lookup = 'attrs__value_%s' % schema.datatype
-            order_lookup = '%s%s' % (direction, value_lookup)
-            return qs.filter(attrs__schema__name=name).order_by(order_lookup)
+            # assume to use the EntityQuerySet
+            return qs.order_by_attrs('%s%s' % (direction, name),
+                                     nulls=self.sort_nulls)
         else:
             raise NameError('Cannot order items by attributes: unknown '
                             'attribute "%s". Available fields: %s. '
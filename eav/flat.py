@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Materialized flat tables for EAV attributes. If an entity model sets
+`flat_table = True`, a wide table with one row per entity and one typed column
+per filtered or sortable schema is kept along with the attribute table::
+
+    class Fruit(BaseEntity):
+        flat_table = True
+
+Rows are updated when attributes are saved via `BaseEntity.save()` or
+`BaseSchema.save_attr()`. `BaseEntityManager.filter()` and sorting methods use
+the flat table instead of attributes if all referenced schemata are
+materialized, so ordinary (composite) indexes on its columns can be used::
+
+    get_flat_table(Fruit).create_index(['colour', 'price_range'])
+
+Many-to-one schemata are not materialized. Columns are added (and filled)
+automatically when a schema is saved; if schema's datatype is changed, the
+table must be rebuilt with the `rebuild_flat_tables` management command.
+Like with schemata (see `eav.registry`), `QuerySet.update()` does not keep
+the table in sync, so `sync()` must be called manually in such cases.
+"""
+
+# django
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import IntegerField
+from django.db.models.sql.where import AND, Constraint, WhereNode
+
+# this app
+from registry import registry
+
+
+__all__ = ['FlatTable', 'get_flat_table']
+
+
+# entity model --> FlatTable instance (or None if the model has no flat table)
+_tables = {}
+
+
+def get_flat_table(model):
+    "Returns the `FlatTable` for given entity model or None if it has none."
+    if model not in _tables:
+        enabled = getattr(model, 'flat_table', False)
+        _tables[model] = FlatTable(model) if enabled else None
+    return _tables[model]
+
+
+class FlatSubquery(object):
+    """
+    Selects primary keys of entities whose rows in the flat table match given
+    conditions. Can be used as a value in lookups like ``pk__in``.
+    """
+    value_annotation = True
+
+    def __init__(self, table, where):
+        self.table = table
+        self.where = where
+
+    def _prepare(self):
+        return self
+
+    def _as_sql(self, connection):
+        qn = connection.ops.quote_name
+        sql = 'SELECT %s FROM %s' % (qn('entity_id'), qn(self.table.db_table))
+        where, params = self.where.as_sql(qn, connection)
+        if where:
+            sql = '%s WHERE %s' % (sql, where)
+        return sql, params
+
+
+class FlatTable(object):
+
+    def __init__(self, model):
+        self.model = model
+        self.db_table = '%s_flat' % model._meta.db_table
+        self._columns = {}    # db alias --> (schemata version, column names)
+
+    def _get_connection(self, using=None):
+        return connections[using or router.db_for_write(self.model)]
+
+    def get_schemata(self):
+        "Returns schemata which should be materialized."
+        return [s for s in registry.get_schemata(self.model)
+                if (s.filtered or s.sortable) and s.datatype != s.TYPE_MANY]
+
+    def get_columns(self, schema):
+        """
+        Returns a list of (column name, attribute field name) pairs for given
+        schema. Columns are named after schema's primary key so that renaming
+        a schema does not break anything.
+        """
+        attr_model = schema.value_attrs.model
+        field_names = attr_model(schema=schema).get_value_field_names()
+        if schema.datatype == schema.TYPE_RANGE:
+            return [('attr_%d_%s' % (schema.pk, x.rsplit('_', 1)[1]), x)
+                    for x in field_names]
+        return [('attr_%d' % schema.pk, field_names[0])]
+
+    def _get_existing_columns(self, connection):
+        version = registry.version
+        entry = self._columns.get(connection.alias)
+        if entry is None or entry[0] != version:
+            cursor = connection.cursor()
+            if self.db_table in connection.introspection.get_table_list(cursor):
+                desc = connection.introspection.get_table_description(
+                    cursor, self.db_table)
+                columns = set(row[0] for row in desc)
+            else:
+                columns = set()
+            entry = self._columns[connection.alias] = version, columns
+        return entry[1]
+
+    def is_materialized(self, schema, using=None):
+        "Returns True if given schema has up-to-date columns in the table."
+        connection = self._get_connection(using)
+        if not (schema.filtered or schema.sortable):
+            return False
+        if schema.datatype == schema.TYPE_MANY:
+            return False
+        existing = self._get_existing_columns(connection)
+        return all(c in existing for c, _ in self.get_columns(schema))
+
+    def _get_materialized_columns(self, connection):
+        existing = self._get_existing_columns(connection)
+        result = []
+        for schema in self.get_schemata():
+            columns = self.get_columns(schema)
+            if all(c in existing for c, _ in columns):
+                result.append((schema, columns))
+        return result
+
+    def exists(self, using=None):
+        "Returns True if the table exists in the database."
+        return bool(self._get_existing_columns(self._get_connection(using)))
+
+    def sync(self, using=None):
+        """
+        Creates the table if it does not exist yet and adds columns for
+        schemata which are not materialized yet. New columns are filled with
+        existing attribute values and indexed.
+        """
+        connection = self._get_connection(using)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        self._columns.pop(connection.alias, None)
+        existing = self._get_existing_columns(connection)
+        if not existing:
+            cursor.execute('CREATE TABLE %s (%s %s NOT NULL PRIMARY KEY)' % (
+                qn(self.db_table), qn('entity_id'),
+                IntegerField().db_type(connection=connection)))
+
+        # rows are not created while there are no columns
+        opts = self.model._meta
+        cursor.execute('INSERT INTO %(flat)s (%(id)s) SELECT %(pk)s FROM '
+                       '%(entity)s WHERE %(pk)s NOT IN (SELECT %(id)s FROM '
+                       '%(flat)s)' % {
+                           'flat': qn(self.db_table),
+                           'id': qn('entity_id'),
+                           'entity': qn(opts.db_table),
+                           'pk': qn(opts.pk.column),
+                       })
+        ctype = ContentType.objects.get_for_model(self.model)
+        for schema in self.get_schemata():
+            attr_opts = schema.value_attrs.model._meta
+            for column, field_name in self.get_columns(schema):
+                if column in existing:
+                    continue
+                field = attr_opts.get_field(field_name)
+                cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    qn(self.db_table), qn(column),
+                    field.db_type(connection=connection)))
+                cursor.execute(
+                    'UPDATE %(flat)s SET %(column)s = (SELECT %(value)s '
+                    'FROM %(attrs)s WHERE %(ctype)s = %%s AND %(schema)s = %%s '
+                    'AND %(attrs)s.%(entity)s = %(flat)s.%(pk)s)' % {
+                        'flat': qn(self.db_table),
+                        'column': qn(column),
+                        'value': qn(field.column),
+                        'attrs': qn(attr_opts.db_table),
+                        'ctype': qn(attr_opts.get_field('entity_type').column),
+                        'schema': qn(attr_opts.get_field('schema').column),
+                        'entity': qn(attr_opts.get_field('entity_id').column),
+                        'pk': qn('entity_id'),
+                    }, [ctype.pk, schema.pk])
+                self._create_index(connection, [column])
+        transaction.commit_unless_managed(using=connection.alias)
+        self._columns.pop(connection.alias, None)
+
+    def drop(self, using=None):
+        "Drops the table (if it exists)."
+        connection = self._get_connection(using)
+        cursor = connection.cursor()
+        if self.db_table in connection.introspection.get_table_list(cursor):
+            cursor.execute('DROP TABLE %s' % connection.ops.quote_name(self.db_table))
+            transaction.commit_unless_managed(using=connection.alias)
+        self._columns.pop(connection.alias, None)
+
+    def rebuild(self, using=None):
+        "Re-creates the table from scratch."
+        self.drop(using)
+        self.sync(using)
+
+    def _create_index(self, connection, columns):
+        qn = connection.ops.quote_name
+        name = truncate_name('%s_%s' % (self.db_table, '_'.join(columns)),
+                             connection.ops.max_name_length())
+        cursor = connection.cursor()
+        cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+            qn(name), qn(self.db_table), ', '.join(qn(c) for c in columns)))
+
+    def create_index(self, names, using=None):
+        """
+        Creates a composite index on columns for schemata with given names.
+        The schemata must be materialized.
+        """
+        schemata = registry.get_schemata_dict(self.model)
+        columns = []
+        for name in names:
+            if not self.is_materialized(schemata[name], using):
+                raise ValueError('Schema "%s" is not materialized.' % name)
+            columns.extend(c for c, _ in self.get_columns(schemata[name]))
+        connection = self._get_connection(using)
+        self._create_index(connection, columns)
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def update_row(self, entity_id, values, using=None):
+        """
+        Stores given attribute values (a dictionary keyed by schema name) in
+        the row for given entity. The row is created if it does not exist.
+        """
+        connection = self._get_connection(using)
+        qn = connection.ops.quote_name
+        columns, params = self._get_row_params(connection, values)
+        if not columns:
+            return
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s WHERE %s = %%s' % (
+            qn(self.db_table), ', '.join('%s = %%s' % qn(c) for c in columns),
+            qn('entity_id')), params + [entity_id])
+        if not cursor.rowcount:
+            self.insert_rows([(entity_id, values)], using=connection.alias)
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def insert_rows(self, rows, using=None):
+        "Inserts rows for given pairs of entity id and attribute values."
+        if not rows:
+            return
+        connection = self._get_connection(using)
+        qn = connection.ops.quote_name
+        all_params = []
+        for entity_id, values in rows:
+            columns, params = self._get_row_params(connection, values)
+            all_params.append([entity_id] + params)
+        columns = ['entity_id'] + columns
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(self.db_table), ', '.join(qn(c) for c in columns),
+            ', '.join(['%s'] * len(columns))), all_params)
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def delete_row(self, entity_id, using=None):
+        connection = self._get_connection(using)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s = %%s' % (
+            qn(self.db_table), qn('entity_id')), [entity_id])
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def _get_row_params(self, connection, values):
+        columns = []
+        params = []
+        for schema, schema_columns in self._get_materialized_columns(connection):
+            value = values.get(schema.name)
+            if schema.datatype == schema.TYPE_RANGE:
+                value = value or (None, None)
+            else:
+                value = [value]
+            attr_opts = schema.value_attrs.model._meta
+            for (column, field_name), x in zip(schema_columns, value):
+                field = attr_opts.get_field(field_name)
+                columns.append(column)
+                params.append(field.get_db_prep_save(x, connection=connection))
+        return columns, params
+
+    def get_subquery(self, conditions, using=None):
+        """
+        Returns a `FlatSubquery` for given list of (schema, attribute lookups)
+        pairs, e.g. ``[(colour, {'value_text': 'red'})]``. All schemata must
+        be materialized.
+        """
+        where = WhereNode()
+        for schema, lookups in conditions:
+            columns = dict((f, c) for c, f in self.get_columns(schema))
+            attr_opts = schema.value_attrs.model._meta
+            for lookup, value in lookups.items():
+                field_name, _, lookup_type = lookup.partition('__')
+                lookup_type = lookup_type or 'exact'
+                if lookup_type == 'exact' and value is None:
+                    lookup_type, value = 'isnull', True
+                field = attr_opts.get_field(field_name)
+                constraint = Constraint(None, columns[field_name], field)
+                where.add((constraint, lookup_type, value), AND)
+        return FlatSubquery(self, where)
+
+    def get_value_sql(self, schema, using=None):
+        """
+        Returns SQL for a scalar subquery which selects the value of given
+        schema for the entity in the outer query (e.g. to sort by it).
+        """
+        qn = self._get_connection(using).ops.quote_name
+        opts = self.model._meta
+        return '(SELECT %s FROM %s WHERE %s.%s = %s.%s)' % (
+            qn(self.get_columns(schema)[0][0]), qn(self.db_table),
+            qn(self.db_table), qn('entity_id'),
+            qn(opts.db_table), qn(opts.pk.column))
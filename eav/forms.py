@@ -26,15 +26,24 @@ from django.forms import (BooleanField, CharField, CheckboxSelectMultiple,
                           DateField, FloatField, ModelForm, ModelMultipleChoiceField,    #MultipleChoiceField,
                           ValidationError)
 from django.contrib.admin.widgets import AdminDateWidget, FilteredSelectMultiple    #, RelatedFieldWidgetWrapper
+from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext_lazy as _
 
 # this app
+from caching import get_choices_version
 from fields import RangeField
+from instrumentation import track
+from registry import registry
 
 
 __all__ = ['BaseSchemaForm', 'BaseDynamicEntityForm']
 
 
+# maximum number of cached sets of form fields (or form classes) per module;
+# the cache is simply dropped when it grows too large
+FORM_CACHE_SIZE = 200
+
+
 class BaseSchemaForm(ModelForm):
 
     def clean_name(self):
@@ -55,6 +64,15 @@ class BaseDynamicEntityForm(ModelForm):
     fields are used. However, on form validation the schema will be retrieved
     and EAV fields dynamically added to the form, so when the validation is
     actually done, all EAV fields are present in it (unless Rubric is not defined).
+
+    Dynamic fields are built once per form class and set of schemata, and are
+    rebuilt when any schema (or a choice of a many-to-one schema) changes.
+    Each form instance only gets a copy of them and its own initial data.
+    Choices of all many-to-one schemata are fetched with a single query and
+    stored in the fields, so rendering them does not hit the database.
+
+    Callables in `FIELD_EXTRA` get the schema. Unless `FIELD_EXTRA` defines
+    a widget for many-to-one schemata, it depends on the number of choices.
     """
 
     FIELD_CLASSES = {
@@ -67,13 +85,10 @@ class BaseDynamicEntityForm(ModelForm):
     }
     FIELD_EXTRA = {
         'date': {'widget': AdminDateWidget},
-        'many': lambda schema: {
-            'widget': CheckboxSelectMultiple
-                      if len(schema.get_choices()) <= 5 else
-                      FilteredSelectMultiple(schema.title, is_stacked=False)
-        },
     }
     def __init__(self, data=None, *args, **kwargs):
+        # a formset may share a dictionary of built fields with its forms
+        self._dynamic_fields = kwargs.pop('dynamic_fields', None)
         super(BaseDynamicEntityForm, self).__init__(data, *args, **kwargs)
         self._build_dynamic_fields()
 
@@ -84,41 +99,105 @@ class BaseDynamicEntityForm(ModelForm):
         """
         return bool(self.instance)# and self.instance.check_eav_allowed()) # XXX would break form where stuff is _being_ defined
 
+    @track('form')
     def _build_dynamic_fields(self):
-        # reset form fields
-        self.fields = deepcopy(self.base_fields)
-
         # do not display dynamic fields if some fields are yet defined
         if not self.check_eav_allowed():
+            self.fields = deepcopy(self.base_fields)
             return
 
-        for schema in self.instance.get_schemata():
-
-            defaults = {
-                'label':     schema.title.capitalize(),
-                'required':  schema.required,
-                'help_text': schema.help_text,
-            }
-
-            datatype = schema.datatype
-            if datatype == schema.TYPE_MANY:
-                choices = getattr(self.instance, schema.name)
-                defaults.update({'queryset': schema.get_choices(),
-                                 'initial': [x.pk for x in choices]})
-
-            extra = self.FIELD_EXTRA.get(datatype, {})
-            if hasattr(extra, '__call__'):
-                extra = extra(schema)
-            defaults.update(extra)
-
-            MappedField = self.FIELD_CLASSES[datatype]
-            self.fields[schema.name] = MappedField(**defaults)
+        schemata = self.instance.get_schemata()
+        self.fields = deepcopy(self._get_dynamic_fields(schemata))
 
-            # fill initial data (if attribute was already defined)
+        # fill initial data (if attribute was already defined)
+        for schema in schemata:
             value = getattr(self.instance, schema.name)
-            if value and not datatype == schema.TYPE_MANY:    # m2m is already done above
+            if schema.datatype == schema.TYPE_MANY:
+                self.initial.setdefault(schema.name, [x.pk for x in value])
+            elif value:
                 self.initial[schema.name] = value
 
+    @classmethod
+    def get_field_names(cls, instance):
+        """
+        Returns names of fields (both static and dynamic ones) of a form for
+        given entity instance without building the form.
+        """
+        return list(cls.base_fields) + [s.name for s in instance.get_schemata()]
+
+    def _get_dynamic_fields(self, schemata):
+        """
+        Returns form fields (both static and dynamic ones) for given schemata.
+        The fields are shared between form instances and must not be altered.
+        If the form was given a `dynamic_fields` dictionary (e.g. by a
+        formset), the fields are looked up there first.
+        """
+        shared = self._dynamic_fields
+        names = tuple(s.name for s in schemata)
+        if shared is not None and names in shared:
+            dynamic = shared[names]
+        else:
+            key = self._get_fields_cache_key(schemata)
+            dynamic = _fields_cache.get(key)
+            if dynamic is None:
+                dynamic = SortedDict()
+                choices = {}
+                if schemata:
+                    choices = schemata[0].prefetch_choices(schemata)
+                for schema in schemata:
+                    dynamic[schema.name] = self._build_field(schema,
+                                                             choices.get(schema.pk))
+                if len(_fields_cache) >= FORM_CACHE_SIZE:
+                    _fields_cache.clear()
+                _fields_cache[key] = dynamic
+            if shared is not None:
+                shared[names] = dynamic
+        fields = SortedDict(self.base_fields)
+        fields.update(dynamic)
+        return fields
+
+    def _get_fields_cache_key(self, schemata):
+        # form classes are often built per request (e.g. by the admin), so
+        # the key only depends on what the dynamic fields are built from;
+        # many-to-one fields also depend on the choices (e.g. the widget
+        # depends on their number)
+        cls = type(self)
+        return (self._meta.model, id(cls.FIELD_CLASSES), id(cls.FIELD_EXTRA),
+                cls._build_field.im_func, registry.version,
+                tuple((s.pk, get_choices_version(s.pk)
+                             if s.datatype == s.TYPE_MANY else None)
+                      for s in schemata))
+
+    def _build_field(self, schema, choices=None):
+        defaults = {
+            'label':     schema.title.capitalize(),
+            'required':  schema.required,
+            'help_text': schema.help_text,
+        }
+
+        datatype = schema.datatype
+        if datatype == schema.TYPE_MANY:
+            defaults.update({'queryset': schema.get_choices(),
+                             'cache_choices': True,
+                             'widget': CheckboxSelectMultiple
+                                       if len(choices) <= 5 else
+                                       FilteredSelectMultiple(schema.title,
+                                                              is_stacked=False)})
+
+        extra = self.FIELD_EXTRA.get(datatype, {})
+        if hasattr(extra, '__call__'):
+            extra = extra(schema)
+        defaults.update(extra)
+
+        MappedField = self.FIELD_CLASSES[datatype]
+        field = MappedField(**defaults)
+        if datatype == schema.TYPE_MANY:
+            # the queryset is only used to validate submitted choices
+            field.choice_cache = [(field.prepare_value(x),
+                                   field.label_from_instance(x))
+                                  for x in choices]
+        return field
+
     def save(self, commit=True):
         """
         Saves this ``form``'s cleaned_data into model instance ``self.instance``
@@ -149,3 +228,7 @@ class BaseDynamicEntityForm(ModelForm):
     def save_m2m(self, *a, **kw):
         # stub for admin    TODO: check if we don't need to super() if entity indeed has m2m
         pass
+
+
+# (form class, schemata version, schemata) --> form fields
+_fields_cache = {}
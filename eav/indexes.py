@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Composite indexes on attribute tables. Lookups by EAV attributes are resolved
+with subqueries like this one::
+
+    SELECT entity_id FROM attr
+    WHERE entity_type_id = %s AND schema_id = %s AND value_float >= %s
+
+An index on ``(schema, value_float, entity_id)`` lets the database find the
+entities without reading the table. Such indexes slow down writes and take
+space, so they are opt-in: list the datatypes in the attribute model (or set
+`value_indexes` to True for all of them)::
+
+    class Attr(BaseAttribute):
+        schema = models.ForeignKey(Schema, related_name='attrs')
+        choice = models.ForeignKey(Choice, related_name='attrs', null=True)
+        value_indexes = ('text', 'float', 'many')
+
+Narrow attribute tables (see `eav.models.BaseValueAttribute`) only have the
+index for their own datatype, and it is declared by default.
+
+Declared indexes are created on `syncdb` for new tables. For existing tables
+use the management command which also reports indexes that are missing (the
+datatype is used by filtered or sortable schemata and has enough rows) or
+unused::
+
+    ./manage.py eav_indexes             # report
+    ./manage.py eav_indexes --create    # create declared indexes
+
+"""
+
+# django
+from django.db import connections, router, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import Count, Q
+
+# this app
+from utils import has_index
+
+
+__all__ = ['get_datatypes', 'get_declared_datatypes', 'get_index_name', 'has_value_index',
+           'create_value_indexes', 'get_index_advice', 'IndexAdvice']
+
+
+# datatype --> names of attribute fields which hold the value
+VALUE_FIELDS = {
+    'text':  ['value_text'],
+    'float': ['value_float'],
+    'date':  ['value_date'],
+    'bool':  ['value_bool'],
+    'many':  ['choice'],
+    'range': ['value_range_min', 'value_range_max'],
+}
+
+# statuses of indexes reported by `get_index_advice()`
+MISSING, OK, UNUSED, NOT_NEEDED = 'missing', 'ok', 'unused', 'not needed'
+
+
+def get_datatypes(model):
+    "Returns datatypes whose values can be stored in given attribute model."
+    datatype = getattr(model, 'datatype', None)
+    if datatype in VALUE_FIELDS:
+        # a narrow table
+        return [datatype]
+    return sorted(VALUE_FIELDS)
+
+
+def get_declared_datatypes(model):
+    "Returns datatypes for which given attribute model declares indexes."
+    declared = getattr(model, 'value_indexes', ())
+    if declared is True:
+        return get_datatypes(model)
+    unknown = set(declared) - set(get_datatypes(model))
+    if unknown:
+        raise ValueError('%s.value_indexes: unknown datatypes %s.'
+                         % (model._meta.object_name, ', '.join(unknown)))
+    return list(declared)
+
+
+def get_index_name(connection, model, datatype):
+    name = '%s_%s_idx' % (model._meta.db_table, datatype)
+    return truncate_name(name, connection.ops.max_name_length())
+
+
+def _get_columns(model, datatype):
+    opts = model._meta
+    names = ['schema'] + VALUE_FIELDS[datatype] + ['entity_id']
+    return [opts.get_field(x).column for x in names]
+
+
+def has_value_index(model, datatype, using=None):
+    "Returns True if the attribute table has an index for given datatype."
+    connection = connections[using or router.db_for_read(model)]
+    return has_index(connection, get_index_name(connection, model, datatype))
+
+
+def create_value_indexes(model, datatypes=None, using=None):
+    """
+    Creates missing indexes on given attribute model for given datatypes
+    (defaults to the declared ones). Returns names of created indexes.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    if datatypes is None:
+        datatypes = get_declared_datatypes(model)
+    created = []
+    cursor = connection.cursor()
+    for datatype in datatypes:
+        if has_value_index(model, datatype, using):
+            continue
+        name = get_index_name(connection, model, datatype)
+        cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+            qn(name), qn(model._meta.db_table),
+            ', '.join(qn(x) for x in _get_columns(model, datatype))))
+        created.append(name)
+    transaction.commit_unless_managed(using=using)
+    return created
+
+
+class IndexAdvice(object):
+    """
+    Describes the state of an index for a datatype: whether the index exists,
+    whether it is declared in the model, how many filtered or sortable
+    schemata use the datatype and how many attribute rows it has.
+    """
+    def __init__(self, datatype, name, exists, declared, schemata, rows,
+                 status):
+        self.datatype = datatype
+        self.name = name
+        self.exists = exists
+        self.declared = declared
+        self.schemata = schemata
+        self.rows = rows
+        self.status = status
+
+    def __repr__(self):
+        return '<IndexAdvice: %s %s>' % (self.datatype, self.status)
+
+    def __unicode__(self):
+        return u'%s: %s %s (%d filtered or sortable schemata, %d rows%s)' % (
+            self.datatype, self.status, self.name, self.schemata, self.rows,
+            '' if self.declared else ', not declared')
+
+
+def get_index_advice(model, min_rows=10000, using=None):
+    """
+    Inspects schemata and attributes of given attribute model and returns a
+    list of `IndexAdvice` objects, one per datatype. An index is considered
+    missing if the datatype is used by filtered or sortable schemata and has
+    at least `min_rows` attribute rows. Makes two grouped queries.
+    """
+    using = using or router.db_for_read(model)
+    connection = connections[using]
+    schema_model = model._meta.get_field('schema').rel.to
+    declared = get_declared_datatypes(model)
+
+    schemata = schema_model._default_manager.db_manager(using) \
+        .filter(Q(filtered=True) | Q(sortable=True)).order_by() \
+        .values_list('datatype').annotate(count=Count('pk'))
+    schemata = dict(schemata)
+    rows = model._default_manager.db_manager(using).order_by() \
+        .values_list('schema__datatype').annotate(count=Count('pk'))
+    rows = dict(rows)
+
+    advice = []
+    for datatype in get_datatypes(model):
+        exists = has_value_index(model, datatype, using)
+        needed = schemata.get(datatype) and rows.get(datatype, 0) >= min_rows
+        if needed:
+            status = OK if exists else MISSING
+        elif exists and not schemata.get(datatype):
+            status = UNUSED
+        else:
+            status = OK if exists else NOT_NEEDED
+        advice.append(IndexAdvice(datatype,
+                                  get_index_name(connection, model, datatype),
+                                  exists, datatype in declared,
+                                  schemata.get(datatype, 0),
+                                  rows.get(datatype, 0), status))
+    return advice
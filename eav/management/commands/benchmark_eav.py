@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Times the core EAV operations against a synthetic catalog. Usage::
+
+    ./manage.py benchmark_eav --entities=5000 --output=before.json
+    ./manage.py benchmark_eav --entities=5000 --compare=before.json
+
+The catalog is generated in a temporary test database. See `eav.benchmarks`.
+"""
+
+# python
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+
+class Command(BaseCommand):
+    help = 'Times the core EAV operations against a synthetic catalog.'
+    option_list = BaseCommand.option_list + (
+        make_option('--entities', type='int', default=1000,
+                    help='Number of entities (default: 1000).'),
+        make_option('--schemata', type='int', default=10,
+                    help='Number of schemata (default: 10).'),
+        make_option('--choices', type='int', default=5,
+                    help='Number of distinct values per schema (default: 5).'),
+        make_option('--repeat', type='int', default=3,
+                    help='Number of runs per operation (default: 3).'),
+        make_option('--seed', type='int', default=0,
+                    help='Seed for random values (default: 0).'),
+        make_option('--output', help='Write the JSON report to given file.'),
+        make_option('--compare', help='Compare results with given report.'),
+    )
+
+    def handle(self, **options):
+        old_report = None
+        if options['compare']:
+            try:
+                old_report = simplejson.load(open(options['compare']))
+            except (IOError, ValueError), e:
+                raise CommandError('Cannot read report "%s": %s'
+                                   % (options['compare'], e))
+
+        # the benchmarks use models from the tests, so their tables only
+        # exist in the test database
+        from eav.benchmarks import compare_reports, run_benchmarks
+        verbosity = int(options.get('verbosity', 1))
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            report = run_benchmarks(entities=options['entities'],
+                                    schemata=options['schemata'],
+                                    choices=options['choices'],
+                                    repeat=options['repeat'],
+                                    seed=options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        data = simplejson.dumps(report, indent=2)
+        if options['output']:
+            f = open(options['output'], 'w')
+            f.write(data)
+            f.close()
+        elif not old_report:
+            self.stdout.write(data + '\n')
+
+        if old_report:
+            for row in compare_reports(old_report, report):
+                name, before, after, ratio, old_queries, new_queries = row
+                self.stdout.write('%-24s %8.4fs %8.4fs %6s %4d -> %d queries\n'
+                                  % (name, before, after,
+                                     '%.2fx' % ratio if ratio else '-',
+                                     old_queries, new_queries))
+        elif verbosity > 1 and options['output']:
+            self.stdout.write('Report written to %s.\n' % options['output'])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Reports composite indexes on attribute tables which are missing or unused,
+and creates the declared ones along with the unique index which single-valued
+attributes need for atomic upserts. Run it with ``--create`` after upgrading
+from a version without these indexes. Usage::
+
+    ./manage.py eav_indexes                     # all attribute models
+    ./manage.py eav_indexes catalog.Attr --min-rows=100000
+    ./manage.py eav_indexes --create
+
+See `eav.indexes` and `eav.utils.create_single_attr_index()`.
+"""
+
+# python
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+
+# this app
+from eav.indexes import create_value_indexes, get_index_advice
+from eav.models import BaseAttribute, BaseValueAttribute
+from eav.utils import create_single_attr_index, has_single_attr_index
+
+
+class Command(BaseCommand):
+    help = 'Reports and creates composite indexes on EAV attribute tables.'
+    args = '[app_label.ModelName ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--create', action='store_true', default=False,
+                    help='Create declared indexes which are missing.'),
+        make_option('--min-rows', dest='min_rows', type='int', default=10000,
+                    help='Do not suggest indexes for datatypes with fewer '
+                         'attribute rows (default: 10000).'),
+        make_option('--database', default=None,
+                    help='Database alias to use.'),
+    )
+
+    def handle(self, *labels, **options):
+        if labels:
+            models = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Wrong model label "%s".' % label)
+                model = get_model(app_label, model_name)
+                if model is None:
+                    raise CommandError('Unknown model "%s".' % label)
+                if not issubclass(model, (BaseAttribute, BaseValueAttribute)):
+                    raise CommandError('Model "%s" is not an EAV attribute '
+                                       'model.' % label)
+                models.append(model)
+        else:
+            models = [m for m in get_models()
+                      if issubclass(m, (BaseAttribute, BaseValueAttribute))]
+
+        using = options['database']
+        for model in models:
+            name = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+            if options['create']:
+                created = create_value_indexes(model, using=using)
+                if issubclass(model, BaseAttribute):
+                    created.append(create_single_attr_index(model, using=using))
+                for index in filter(None, created):
+                    self.stdout.write('%s: created index %s.\n' % (name, index))
+                continue
+            self.stdout.write('%s:\n' % name)
+            if issubclass(model, BaseAttribute):
+                exists = has_single_attr_index(model, using=using)
+                if exists is not None:
+                    self.stdout.write('    upsert: %s\n' % (
+                        'ok' if exists else 'missing (slow and racy saves)'))
+            for advice in get_index_advice(model, min_rows=options['min_rows'],
+                                           using=using):
+                self.stdout.write('    %s\n' % unicode(advice))
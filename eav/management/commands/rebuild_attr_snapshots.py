@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Rebuilds attribute snapshots of existing entities. Usage::
+
+    ./manage.py rebuild_attr_snapshots catalog.Product --batch-size=1000
+
+See `eav.models.AttrSnapshotField`.
+"""
+
+# python
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds EAV attribute snapshots for given entity models.'
+    args = '<app_label.ModelName ...>'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help='Number of entities to process at once.'),
+    )
+
+    def handle(self, *labels, **options):
+        if not labels:
+            raise CommandError('Enter at least one model as app_label.ModelName.')
+        models = []
+        for label in labels:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError('Wrong model label "%s".' % label)
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise CommandError('Unknown model "%s".' % label)
+            if not hasattr(model, '_get_snapshot_field') or \
+               model._get_snapshot_field() is None:
+                raise CommandError('Model "%s" does not have an attribute '
+                                   'snapshot field.' % label)
+            models.append(model)
+
+        for model in models:
+            count = model._default_manager.rebuild_attr_snapshots(
+                batch_size=options['batch_size'])
+            if int(options.get('verbosity', 1)):
+                self.stdout.write('%s: %d snapshot(s) rebuilt.\n'
+                                  % (model._meta.object_name, count))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Re-creates search indexes of given entity models from their attributes.
+Usage::
+
+    ./manage.py rebuild_search_index catalog.Product
+
+See `eav.search`.
+"""
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+# this app
+from eav.search import get_search_index
+
+
+class Command(BaseCommand):
+    help = 'Re-creates EAV search indexes for given entity models.'
+    args = '<app_label.ModelName ...>'
+
+    def handle(self, *labels, **options):
+        if not labels:
+            raise CommandError('Enter at least one model as app_label.ModelName.')
+        indexes = []
+        for label in labels:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError('Wrong model label "%s".' % label)
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise CommandError('Unknown model "%s".' % label)
+            index = get_search_index(model)
+            if index is None:
+                raise CommandError('Model "%s" does not have a search index.'
+                                   % label)
+            indexes.append(index)
+
+        for index in indexes:
+            index.rebuild()
+            if int(options.get('verbosity', 1)):
+                self.stdout.write('%s: search index rebuilt.\n'
+                                  % index.model._meta.object_name)
@@ -20,21 +20,302 @@
 
 # TODO: .filter(size__isnull=True) --> .exclude(attrs__schema='size')
 
-from django.db.models import Manager
+# python
+import operator
+
+# django
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, transaction
+from django.db.models import Manager, Model, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.utils.datastructures import SortedDict
+from django.utils.tree import Node
+
+# this app
+from caching import invalidate_choices
+from flat import get_flat_table
+from instrumentation import track
+from registry import registry
+from search import get_search_index, get_terms
+from utils import bulk_insert
 
 
 RANGE_INTERSECTION_LOOKUP = 'overlaps'
+RANGE_LOOKUPS = ('overlaps', 'contains', 'within', 'equals')
+
+
+class EavQ(Q):
+    """
+    A Q object which understands names of EAV attributes. Can be combined with
+    other Q objects using ``|``, ``&`` and ``~`` and passed to `filter()` or
+    `exclude()` of any entity queryset. Usage::
+
+        Fruit.objects.filter(EavQ(colour='red') | EavQ(size=large))
+        Fruit.objects.filter(EavQ(taste='sweet') & ~EavQ(colour='orange'))
+        Fruit.objects.all().exclude(EavQ(colour='red') | Q(price__gt=5))
+
+    All conditions are compiled into a single SQL statement. Lookups are
+    resolved by the default manager of the entity model which must be a
+    `BaseEntityManager`.
+    """
+    # make sure that a combination of Q and EavQ is an EavQ
+    def __ror__(self, other):
+        return type(self)(other) | self
+
+    def __rand__(self, other):
+        return type(self)(other) & self
+
+    def add_to_query(self, query, used_aliases):
+        manager = query.model._default_manager
+        query.add_q(self._resolve(self, manager), used_aliases)
+
+    def _resolve(self, node, manager):
+        # makes a tree of plain Q objects with EAV lookups replaced by
+        # the underlying ones
+        q = Q()
+        q.connector = node.connector
+        q.negated = node.negated
+        for child in node.children:
+            if isinstance(child, Node):
+                q.children.append(self._resolve(child, manager))
+            else:
+                lookup, value = child
+                lookups = manager._filter_by_lookup(None, lookup, value)
+                q.children.append(Q(**lookups))
+        return q
+
+
+def _iter_tracked(iterator, operation):
+    "Yields items of given iterator tracking each step as given operation."
+    next_item = track(operation)(lambda: iterator.next())
+    while True:
+        try:
+            item = next_item()
+        except StopIteration:
+            return
+        yield item
+
+
+class EntityQuerySet(QuerySet):
+    """
+    QuerySet for entities. Can fetch EAV attributes for all resulting entities
+    at once (see `with_attrs()`).
+    """
+    def __init__(self, *args, **kwargs):
+        super(EntityQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_attrs = False
+        # True if the query has EAV lookups; its queries are attributed to
+        # them (see `eav.instrumentation`)
+        self._eav_lookups = False
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_prefetch_attrs', self._prefetch_attrs)
+        kwargs.setdefault('_eav_lookups', self._eav_lookups)
+        return super(EntityQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def with_attrs(self):
+        """
+        Returns a clone of this queryset that loads EAV attributes of all
+        resulting entities with a single query when evaluated. Usage::
+
+            for product in Product.objects.filter(rubric=1).with_attrs()[:50]:
+                print product.colour, product.size    # no extra queries
+
+        Note that the whole result is fetched at once, so the queryset should
+        be sliced to a reasonable size (e.g. a page of a listing).
+        """
+        return self._clone(_prefetch_attrs=True)
+
+    def order_by_attrs(self, *names, **kwargs):
+        """
+        Returns a clone of this queryset ordered by given fields and/or EAV
+        attributes. Names may be prefixed with "-" for descending order, like
+        in `order_by()`. Usage::
+
+            Product.objects.filter(rubric=1).order_by_attrs('-colour', 'price')
+
+        Values of attributes are selected with a scalar subquery for each
+        entity (from the flat table if the schema is materialized, see
+        `eav.flat`), so entities which lack an attribute are not dropped.
+
+        :param nulls: "last" (default) or "first" to put entities without a
+            value after or before all others regardless of the direction, or
+            None to rely on the database defaults.
+        """
+        nulls = kwargs.pop('nulls', 'last')
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s'
+                            % ', '.join(kwargs))
+        if nulls not in ('first', 'last', None):
+            raise ValueError('Expected "first", "last" or None, got "%s".'
+                             % nulls)
+        manager = self.model._default_manager
+        select = SortedDict()
+        params = []
+        ordering = []
+        for i, name in enumerate(names):
+            direction = '-' if name.startswith('-') else ''
+            sql, sql_params = manager.get_sort_expression(name.lstrip('-'),
+                                                          using=self.db)
+            if sql is None:
+                ordering.append(name)
+                continue
+            alias = 'eav_sort_%d' % i
+            if nulls:
+                select['%s_null' % alias] = '%s IS NULL' % sql
+                params.extend(sql_params)
+                ordering.append('%s%s_null' % ('-' if nulls == 'first' else '',
+                                               alias))
+            select[alias] = sql
+            params.extend(sql_params)
+            ordering.append(direction + alias)
+        return self.extra(select=select, select_params=params,
+                          order_by=ordering)
+
+    def search(self, query):
+        """
+        Returns a clone of this queryset restricted to entities which have all
+        words of given query in their searched text attributes. An empty query
+        does not restrict the results. Usage::
+
+            Product.objects.filter(rubric=1).search('green apple')
+
+        Uses the search index of the model if there is one (see `eav.search`);
+        words are then matched as a whole. Without the index parts of words
+        match, too.
+        """
+        terms = get_terms(query)
+        if not terms:
+            return self._clone()
+        manager = self.model._default_manager
+        qs = self.filter(manager._get_search_q(terms, using=self.db))
+        qs._eav_lookups = True
+        return qs
+
+    def iterator(self):
+        if not self._prefetch_attrs:
+            return self._track_lookups(super(EntityQuerySet, self).iterator())
+        entities = list(self._track_lookups(super(EntityQuerySet, self).iterator()))
+        self.model.prefetch_attrs(entities)
+        return iter(entities)
+
+    def _track_lookups(self, iterator):
+        # fetching of results is attributed to EAV lookups, but the code which
+        # consumes them is not
+        if not self._eav_lookups:
+            return iterator
+        return _iter_tracked(iterator, 'lookup')
+
+    def count(self):
+        count = super(EntityQuerySet, self).count
+        return track('lookup')(count)() if self._eav_lookups else count()
 
 
 class BaseEntityManager(Manager):
 
     # TODO: refactor filter() and exclude()   -- see django.db.models.manager and ...query
 
+    def get_query_set(self):
+        return EntityQuerySet(self.model, using=self._db)
+
+    def with_attrs(self):
+        """
+        Returns a queryset that fetches EAV attributes along with entities.
+        See `EntityQuerySet.with_attrs()`.
+        """
+        return self.get_query_set().with_attrs()
+
+    def order_by_attrs(self, *names, **kwargs):
+        """
+        Returns a queryset ordered by given fields and/or EAV attributes. See
+        `EntityQuerySet.order_by_attrs()`.
+        """
+        return self.get_query_set().order_by_attrs(*names, **kwargs)
+
+    def search(self, query):
+        """
+        Returns a queryset of entities which match given search query. See
+        `EntityQuerySet.search()`.
+        """
+        return self.get_query_set().search(query)
+
+    def _get_search_q(self, terms, using=None):
+        """
+        Returns a Q object which selects entities with all given terms in
+        their searched attributes. Without a search index each term is looked
+        up with ``icontains`` in attributes of all searched text schemata.
+        """
+        index = get_search_index(self.model)
+        if index and index.exists(using):
+            return Q(pk__in=index.get_subquery(terms))
+        schemata = [s for s in registry.get_schemata(self.model)
+                    if s.searched and s.datatype == s.TYPE_TEXT]
+        if not schemata:
+            return Q(pk__in=[])
+        q = Q()
+        for term in terms:
+            q &= reduce(operator.or_, [
+                Q(pk__in=self._get_attr_subquery(schema, self.model,
+                                                 value_text__icontains=term))
+                for schema in schemata])
+        return q
+
+    def get_sort_expression(self, name, using=None):
+        """
+        Returns SQL expression (and its params) which selects the value of
+        given field or EAV attribute of an entity. Returns None instead of
+        the expression if the name must be handled by `order_by()`, i.e.
+        refers to a related model.
+        """
+        opts = self.model._meta
+        qn = connections[using or self.db].ops.quote_name
+        if name == 'pk':
+            name = opts.pk.name
+        if '__' in name:
+            return None, []
+        if name in opts.get_all_field_names():
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return None, []
+            if field.rel:
+                return None, []
+            return '%s.%s' % (qn(opts.db_table), qn(field.column)), []
+
+        schemata = registry.get_schemata_dict(self.model)
+        if name not in schemata:
+            raise NameError('Cannot order items by attributes: unknown '
+                            'attribute "%s". Available fields: %s. '
+                            'Available schemata: %s.' % (name,
+                            ', '.join(opts.get_all_field_names()),
+                            ', '.join(schemata)))
+        schema = schemata[name]
+        if schema.datatype == schema.TYPE_MANY:
+            raise ValueError('Cannot order items by many-to-one attribute '
+                             '"%s".' % name)
+        table = get_flat_table(self.model)
+        if table and table.is_materialized(schema, using):
+            return table.get_value_sql(schema, using), []
+        attr_model = schema.value_attrs.model
+        attr_opts = attr_model._meta
+        field_name = attr_model(schema=schema).get_value_field_names()[0]
+        sql = ('(SELECT %s FROM %s WHERE %s = %%s AND %s = %s.%s AND %s = %%s)'
+               % (qn(attr_opts.get_field(field_name).column),
+                  qn(attr_opts.db_table),
+                  qn(attr_opts.get_field('entity_type').column),
+                  qn(attr_opts.get_field('entity_id').column),
+                  qn(opts.db_table), qn(opts.pk.column),
+                  qn(attr_opts.get_field('schema').column)))
+        ctype = ContentType.objects.get_for_model(self.model)
+        return sql, [ctype.pk, schema.pk]
+
     def exclude(self, *args, **kw):
         qs = self.get_query_set().exclude(*args)
         for lookup, value in kw.items():
             lookups = self._filter_by_lookup(qs, lookup, value)
             qs = qs.exclude(**lookups)
+            qs._eav_lookups |= lookups != {lookup: value}
         return qs
 
     def filter(self, *args, **kw):
@@ -50,17 +331,58 @@ class BaseEntityManager(Manager):
         """
 
         qs = self.get_query_set().filter(*args)
+        subquery, kw = self._filter_by_flat_table(kw)
+        if subquery is not None:
+            qs = qs.filter(pk__in=subquery)
+            qs._eav_lookups = True
         for lookup, value in kw.items():
             lookups = self._filter_by_lookup(qs, lookup, value)
             qs = qs.filter(**lookups)
+            qs._eav_lookups |= lookups != {lookup: value}
         return qs
 
+    @track('lookup')
+    def _filter_by_flat_table(self, kw):
+        """
+        Returns a subquery for the flat table (see `eav.flat`) which combines
+        all EAV lookups from given dictionary, and the dictionary of remaining
+        lookups. If the model has no flat table or any of the referenced
+        schemata is not materialized, returns None and unchanged lookups.
+        """
+        table = get_flat_table(self.model)
+        if table is None:
+            return None, kw
+        fields = self.model._meta.get_all_field_names()
+        schemata = registry.get_schemata_dict(self.model)
+        conditions = []
+        rest = {}
+        for lookup, value in kw.items():
+            name, _, sublookup = lookup.partition('__')
+            if name in fields or name not in schemata:
+                rest[lookup] = value
+                continue
+            schema = schemata[name]
+            if not table.is_materialized(schema):
+                return None, kw
+            if schema.datatype == schema.TYPE_RANGE:
+                lookups = self._get_range_lookups(sublookup, value)
+            else:
+                value_lookup = 'value_%s' % schema.datatype
+                if sublookup:
+                    value_lookup = '%s__%s' % (value_lookup, sublookup)
+                lookups = {value_lookup: value}
+            conditions.append((schema, lookups))
+        if not conditions:
+            return None, kw
+        return table.get_subquery(conditions), rest
+
+    @track('lookup')
     def _filter_by_lookup(self, qs, lookup, value):
 
         # TODO: refactor (make recursive resolving of sublookups)
 
         fields   = self.model._meta.get_all_field_names()
-        schemata = dict((s.name, s) for s in self.model.get_schemata_for_model())
+        schemata = registry.get_schemata_dict(self.model)
 
         if '__' in lookup:
             name, sublookup = lookup.split('__', 1)
@@ -83,7 +405,7 @@ class BaseEntityManager(Manager):
                 # check if sublookup is another schema
                 # TODO: handle nested sublookups (probably these blocks should be taken out of the Manager)
 
-                related_schemata = dict((s.name, s) for s in related_model.get_schemata_for_model())
+                related_schemata = registry.get_schemata_dict(related_model)
                 if '__' in sublookup:
                     subname, subsublookup = sublookup.split('__', 1)
                 else:
@@ -94,18 +416,23 @@ class BaseEntityManager(Manager):
                     if schema.datatype == schema.TYPE_MANY:
                         d = self._filter_by_m2m_schema(qs, subname, subsublookup, value, schema, model=related_model)
                     elif schema.datatype == schema.TYPE_RANGE:
-                        d = self._filter_by_range_schema(qs, subname, subsublookup, value, schema)
+                        d = self._filter_by_range_schema(qs, subname, subsublookup, value, schema, model=related_model)
                     else:
-                        d = self._filter_by_simple_schema(qs, subname, subsublookup, value, schema)
+                        d = self._filter_by_simple_schema(qs, subname, subsublookup, value, schema, model=related_model)
                     prefixed = dict(('%s__%s' % (name, k), v) for k, v in d.items())
-                    #assert 1==0, (schema, prefixed)
-                    return prefixed
+                    # the relation may be multi-valued (e.g. a reverse FK), so
+                    # join it within a subquery to avoid duplicate rows
+                    related = QuerySet(self.model).filter(**prefixed)
+                    return {'pk__in': related.order_by().values('pk')}
             # okay, treat as ordinary model field
             return {lookup: value}
 
         elif name in schemata:
             # EAV attribute (Attr instance linked to entity)
             schema = schemata.get(name)
+            subquery, _ = self._filter_by_flat_table({lookup: value})
+            if subquery is not None:
+                return {'pk__in': subquery}
             if schema.datatype == schema.TYPE_MANY:
                 return self._filter_by_m2m_schema(qs, name, sublookup, value, schema)
             elif schema.datatype == schema.TYPE_RANGE:
@@ -118,57 +445,129 @@ class BaseEntityManager(Manager):
                             'Available schemata: %s.' % (name,
                             ', '.join(fields), ', '.join(schemata)))
 
-    def _filter_by_simple_schema(self, qs, lookup, sublookup, value, schema):
+    def _get_attr_subquery(self, schema, model, **lookups):
+        """
+        Returns a subquery which selects primary keys of entities of given
+        model that have an attribute of given schema matching given lookups.
+
+        Filtering by ``pk__in=subquery`` (instead of joining the attributes
+        table) yields no duplicates, so `distinct()` is not needed, and does
+        not add a join per lookup. The subquery can be resolved with an index
+        on ``(schema, value_*, entity_id)``.
+        """
+        ctype = ContentType.objects.get_for_model(model)
+        attrs = schema.value_attrs.filter(entity_type=ctype, **lookups)
+        return attrs.order_by().values('entity_id')
+
+    def _filter_by_simple_schema(self, qs, lookup, sublookup, value, schema, model=None):
         """
         Filters given entity queryset by an attribute which is linked to given
         schema and has given value in the field for schema's datatype.
         """
-        value_lookup = 'attrs__value_%s' % schema.datatype
+        value_lookup = 'value_%s' % schema.datatype
         if sublookup:
             value_lookup = '%s__%s' % (value_lookup, sublookup)
-        return {
-            'attrs__schema': schema,
-            str(value_lookup): value
-        }
+        lookups = {str(value_lookup): value}
+        return {'pk__in': self._get_attr_subquery(schema, model or self.model, **lookups)}
 
-    def _filter_by_range_schema(self, qs, lookup, sublookup, value, schema):
+    def _filter_by_range_schema(self, qs, lookup, sublookup, value, schema, model=None):
         """
         Filters given entity queryset by an attribute which is linked to given
-        range schema. Lookups `between` yields items that lie not completely
-        within given range but have intersection with it. For example, and item
-        with x=(2,5) will match q=(3,None) or q=(0,3). See tests for details.
+        range schema. Supported lookups:
+
+        * `overlaps` (default) yields items whose ranges have intersection
+          with given one. For example, an item with x=(2,5) will match
+          q=(3,None) or q=(0,3);
+        * `contains` yields items whose ranges include given range or number;
+        * `within` yields items whose ranges lie within given range;
+        * `equals` yields items with exactly given range.
+
+        A bound which is None is not checked. Usage::
 
             qs.filter(weight_range__overlaps=(1,3))
-            qs.filter(weight_range__overlaps=(1,None))
+            qs.filter(weight_range=(1,None))
+            qs.filter(weight_range__contains=2)
+            qs.filter(weight_range__within=(0,10))
 
+        See tests for details.
         """
-        # This code was written with a single use case in mind. That use case
-        # required searching for objects whose ranges *intersect* with given
-        # one. I did not invest time in supporting other use cases (such as
-        # checking whether the ranges are exactly the same or how they are
-        # different). However, such lookups *can* be added later without
-        # breaking existing client code. Patches are welcome.
+        conditions = self._get_range_lookups(sublookup, value)
+        subquery = self._get_attr_subquery(schema, model or self.model, **conditions)
+        bound = self._get_range_bound(schema, sublookup, value)
+        if bound:
+            sql, params = bound
+            subquery = subquery.extra(where=[sql], params=params)
+        return {'pk__in': subquery}
+
+    def _clean_range_lookup(self, sublookup, value):
+        "Returns normalized range lookup and its min and max values."
         sublookup = sublookup or RANGE_INTERSECTION_LOOKUP
-        if not sublookup == RANGE_INTERSECTION_LOOKUP:
-            raise ValueError('Range schema only supports lookup "%s".' %
-                             RANGE_INTERSECTION_LOOKUP)
+        if sublookup not in RANGE_LOOKUPS:
+            raise ValueError('Range schema only supports lookups "%s".' %
+                             '", "'.join(RANGE_LOOKUPS))
+        if sublookup == 'contains' and not hasattr(value, '__iter__'):
+            # a point is an empty range
+            value = value, value
         try:
-            _, _ = value
+            start, stop = value
         except ValueError:
             raise ValueError('Range schema value must be a tuple of min and '
                              'max values; one of them may be None.')
         except TypeError:
             raise TypeError('Expected a two-tuple, got "%s"' % value)
+        return sublookup, start, stop
+
+    def _get_range_lookups(self, sublookup, value):
+        "Returns attribute lookups for given range lookup and value."
+        sublookup, start, stop = self._clean_range_lookup(sublookup, value)
+        if sublookup == RANGE_INTERSECTION_LOOKUP:
+            value_lookups = [('value_range_max__gte', start),
+                             ('value_range_min__lte', stop)]
+        elif sublookup == 'contains':
+            value_lookups = [('value_range_min__lte', start),
+                             ('value_range_max__gte', stop)]
+        elif sublookup == 'within':
+            value_lookups = [('value_range_min__gte', start),
+                             ('value_range_max__lte', stop),
+                             # implied, but lets the index limit the scan
+                             ('value_range_min__lte', stop)]
+        else:
+            value_lookups = [('value_range_min', start),
+                             ('value_range_max', stop)]
+        return dict((k,v) for k,v in value_lookups if v is not None)
 
-        value_lookups = zip((
-            'attrs__value_range_max__gte',
-            'attrs__value_range_min__lte',
-        ), value)
-        conditions = dict((k,v) for k,v in value_lookups if v is not None)
-        conditions.update({
-            'attrs__schema': schema,
-        })
-        return conditions
+    def _get_range_bound(self, schema, sublookup, value):
+        """
+        Returns SQL condition (and its params) which limits lower bounds of
+        ranges matching given lookup, or None if the lookup needs no limit.
+
+        Stored ranges are sorted by their lower bound in the range index (see
+        `eav.indexes`) but overlap and containment lookups only limit it from
+        above, so the index would be scanned from the beginning. A range
+        which ends at or after point x cannot start before x minus the length
+        of the longest stored range, and that length is selected by a scalar
+        subquery (evaluated once per query), so the condition never depends on
+        stale data.
+        """
+        sublookup, start, stop = self._clean_range_lookup(sublookup, value)
+        end_point = {RANGE_INTERSECTION_LOOKUP: start, 'contains': stop}.get(sublookup)
+        if end_point is None:
+            return None
+        opts = schema.value_attrs.model._meta
+        qn = connections[router.db_for_read(self.model)].ops.quote_name
+        columns = {
+            'table': qn(opts.db_table),
+            'min': qn(opts.get_field('value_range_min').column),
+            'max': qn(opts.get_field('value_range_max').column),
+            'schema': qn(opts.get_field('schema').column),
+        }
+        # the column is not qualified because the table is relabeled when the
+        # attribute query becomes a subquery; the factor and the shifted point
+        # leave some room for rounding errors of float arithmetic
+        sql = ('%(min)s >= %%s - (SELECT MAX(eav_span.%(max)s - '
+               'eav_span.%(min)s) FROM %(table)s eav_span WHERE '
+               'eav_span.%(schema)s = %%s) * 1.000000001' % columns)
+        return sql, [end_point - 1e-9 * (abs(end_point) + 1), schema.pk]
 
     def _filter_by_m2m_schema(self, qs, lookup, sublookup, value, schema, model=None):
         """
@@ -176,17 +575,15 @@ class BaseEntityManager(Manager):
         many-to-many schema.
         """
         model = model or self.model
-        schemata = dict((s.name, s) for s in model.get_schemata_for_model())   # TODO cache this dict, see above too
+        schemata = registry.get_schemata_dict(model)
         try:
             schema = schemata[lookup]
         except KeyError:
             # TODO: smarter error message, i.e. how could this happen and what to do
             raise ValueError(u'Could not find schema for lookup "%s"' % lookup)
         sublookup = '__%s'%sublookup if sublookup else ''
-        return {
-            'attrs__schema': schema,
-            'attrs__choice%s'%sublookup: value,  # TODO: can we filter by id, not name?
-        }
+        lookups = {'choice%s'%sublookup: value}  # TODO: can we filter by id, not name?
+        return {'pk__in': self._get_attr_subquery(schema, model, **lookups)}
 
     def create(self, **kwargs):
         """
@@ -201,7 +598,7 @@ class BaseEntityManager(Manager):
         """
 
         fields = self.model._meta.get_all_field_names()
-        schemata = dict((s.name, s) for s in self.model.get_schemata_for_model())
+        schemata = registry.get_schemata_dict(self.model)
 
         # check if all attributes are known
         possible_names = set(fields) | set(schemata.keys())
@@ -224,6 +621,124 @@ class BaseEntityManager(Manager):
 
         return instance
 
+    def bulk_create_with_attrs(self, rows, batch_size=500):
+        """
+        Creates entities and related Attr instances in batches. Much faster
+        than calling `create()` for each entity when importing lots of data.
+        Usage::
+
+            Fruit.objects.bulk_create_with_attrs([
+                {'title': 'Apple', 'colour': 'green', 'size': [small, large]},
+                {'title': 'Lemon', 'colour': 'yellow'},
+            ])
+
+        :param rows: an iterable of dictionaries which mix model fields and
+            schema names, like keyword arguments for `create()`.
+        :param batch_size: number of entities to process at once. Attributes
+            of all entities in a batch are inserted with a single query and
+            each batch is committed separately, unless the transaction is
+            managed by the caller (e.g. with `commit_on_success`): then
+            nothing is committed and the caller decides what to do.
+
+        Each entity is still inserted with a separate query because its
+        primary key is needed for its attributes. Entities are saved without
+        calling their `save()` method and no signals are sent for attributes.
+
+        Returns the number of created entities.
+        """
+        using = self._db or router.db_for_write(self.model)
+        fields = self.model._meta.get_all_field_names()
+        schemata = registry.get_schemata_dict(self.model)
+        count = 0
+
+        # commit batches only if the caller does not manage the transaction
+        commit = not transaction.is_managed(using=using)
+        if commit:
+            transaction.enter_transaction_management(using=using)
+            transaction.managed(True, using=using)
+        try:
+            batch = []
+            for row in rows:
+                wrong_names = set(row) - set(fields) - set(schemata)
+                if wrong_names:
+                    raise NameError('Cannot create %s: unknown attribute(s) '
+                                    '"%s".' % (self.model._meta.object_name,
+                                               '", "'.join(wrong_names)))
+                batch.append(row)
+                if len(batch) == batch_size:
+                    count += self._bulk_create_batch(batch, fields, schemata,
+                                                     using, commit)
+                    batch = []
+            if batch:
+                count += self._bulk_create_batch(batch, fields, schemata,
+                                                 using, commit)
+        except:
+            if commit:
+                transaction.rollback(using=using)
+                transaction.leave_transaction_management(using=using)
+            raise
+        if commit:
+            transaction.leave_transaction_management(using=using)
+        return count
+
+    def _bulk_create_batch(self, rows, fields, schemata, using, commit=True):
+        snapshot_field = self.model._get_snapshot_field()
+        flat_table = get_flat_table(self.model)
+        search_index = get_search_index(self.model)
+        flat_rows = []
+        attrs = {}
+        for row in rows:
+            instance = self.model(**dict((k,v) for k,v in row.items() if k in fields))
+            instance_attrs = []
+            values = {}
+            for name, value in row.items():
+                if name in schemata:
+                    schema = schemata[name]
+                    for attr in schema.build_attrs(instance, value):
+                        instance_attrs.append(attr)
+                        if schema.datatype == schema.TYPE_MANY:
+                            values.setdefault(name, []).append(attr.value)
+                        else:
+                            values[name] = attr.value
+            if snapshot_field:
+                setattr(instance, snapshot_field.attname,
+                        instance._dump_attr_snapshot(values))
+            Model.save(instance, force_insert=True, using=using)
+            flat_rows.append((instance.pk, values))
+            for attr in instance_attrs:
+                attr.entity_id = instance.pk
+                attrs.setdefault(type(attr), []).append(attr)
+        for attr_model, objects in attrs.items():
+            bulk_insert(attr_model, objects, using=using)
+            for schema_id in set(x.schema_id for x in objects):
+                invalidate_choices(schema_id)
+        if flat_table:
+            flat_table.insert_rows(flat_rows, using=using)
+        if search_index:
+            search_index.insert_rows(flat_rows, using=using)
+        if commit:
+            transaction.commit(using=using)
+        return len(rows)
+
+    def rebuild_attr_snapshots(self, batch_size=500):
+        """
+        Re-reads attributes of all entities from the database and updates
+        their snapshots (see `eav.models.AttrSnapshotField`). Entities are
+        processed in batches; attributes are fetched with a single query per
+        batch. Returns the number of processed entities.
+        """
+        field = self.model._get_snapshot_field()
+        if field is None:
+            raise TypeError('%s does not have an attribute snapshot field.'
+                            % self.model._meta.object_name)
+        pks = list(self.values_list('pk', flat=True).order_by('pk'))
+        for offset in range(0, len(pks), batch_size):
+            entities = list(self.filter(pk__in=pks[offset:offset+batch_size]))
+            self.model.prefetch_attrs(entities, snapshot=False)
+            for entity in entities:
+                entity._update_attr_snapshot()
+        return len(pks)
+
 '''
 class BaseSchemaManager(Manager):
 
@@ -18,12 +18,21 @@
 #    You should have received a copy of the GNU Lesser General Public License
 #    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
 
+# python
+from datetime import date
+from itertools import chain
+
 # django
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import router, transaction
 from django.db.models import (BooleanField, CharField, DateField, FloatField,
                               ForeignKey, IntegerField, Model, NullBooleanField,
-                              TextField)
+                              TextField, get_models)
+from django.db.models.signals import post_delete, post_save, post_syncdb
+from django.db.models.sql.subqueries import DeleteQuery
+from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 
 # 3rd-party
@@ -32,10 +41,21 @@ from autoslug.settings import slugify
 #from view_shortcuts.decorators import cached_property
 
 # this app
+from caching import invalidate_choices
+from flat import get_flat_table
+from indexes import create_value_indexes
+from instrumentation import track
 from managers import BaseEntityManager
+from registry import registry
+from search import get_search_index
+from utils import (bulk_insert, create_single_attr_index, reset_upsert_cache,
+                   upsert_attrs)
 
 
-__all__ = ['BaseAttribute', 'BaseChoice', 'BaseEntity', 'BaseSchema']
+__all__ = ['AttrSnapshotField', 'BaseAttribute', 'BaseBooleanAttribute',
+           'BaseChoice', 'BaseDateAttribute', 'BaseEntity',
+           'BaseFloatAttribute', 'BaseRangeAttribute', 'BaseSchema',
+           'BaseTextAttribute', 'BaseValueAttribute']
 
 
 def slugify_attr_name(name):
@@ -79,6 +99,10 @@ class BaseSchema(Model):
     filtered = BooleanField(_('include in filters'))
     sortable = BooleanField(_('allow sorting'))
 
+    # datatype --> related name of a narrow attribute model which stores
+    # values of that datatype instead of `attrs` (see `BaseValueAttribute`)
+    value_relations = {}
+
     class Meta:
         abstract = True
         verbose_name, verbose_name_plural = _('schema'), _('schemata')
@@ -101,13 +125,60 @@ class BaseSchema(Model):
         """
         return self.choices.all()
 
+    @classmethod
+    def prefetch_choices(cls, schemata):
+        """
+        Returns lists of choices for given many-to-one schemata keyed by schema
+        primary key. Choices of all schemata which use the default
+        `get_choices()` are fetched with a single query; schemata which
+        overload it are queried one by one. Usage::
+
+            choices = Schema.prefetch_choices(schemata)
+            choices[schema.pk]    # --> [<Choice: green>, <Choice: red>]
+
+        """
+        schemata = [s for s in schemata if s.datatype == s.TYPE_MANY]
+        result = {}
+        pending = []
+        for schema in schemata:
+            if type(schema).get_choices.im_func is BaseSchema.get_choices.im_func:
+                result[schema.pk] = []
+                pending.append(schema)
+            else:
+                result[schema.pk] = list(schema.get_choices())
+        if pending:
+            choice_model = pending[0].choices.model
+            choices = choice_model._default_manager.filter(schema__in=pending)
+            for choice in choices:
+                result[choice.schema_id].append(choice)
+        return result
+
+    @classmethod
+    def get_value_models(cls):
+        "Returns narrow attribute models declared in `value_relations`."
+        if cls.TYPE_MANY in cls.value_relations:
+            raise ImproperlyConfigured('%s.value_relations: many-to-one '
+                                       'values cannot be stored in a narrow '
+                                       'table.' % cls.__name__)
+        return [getattr(cls, name).related.model
+                for datatype, name in sorted(cls.value_relations.items())]
+
+    @property
+    def value_attrs(self):
+        """
+        Returns the related manager for attributes which store values of this
+        schema: either `attrs` or the narrow table for schema's datatype.
+        """
+        return getattr(self, self.value_relations.get(self.datatype, 'attrs'))
+
     def get_attrs(self, entity):
         """
         Returns available attributes for given entity instance.
         Handles many-to-one relations transparently.
         """
-        return self.attrs.filter(**get_entity_lookups(entity))
+        return self.value_attrs.filter(**get_entity_lookups(entity))
 
+    @track('attr_save')
     def save_attr(self, entity, value):
         """
         Saves given EAV attribute with given value for given entity.
@@ -126,38 +197,108 @@ class BaseSchema(Model):
           processed as above (i.e. "foo" --> ["foo"]).
         """
 
+        self._save_attr(entity, value)
+        entity._update_attr_copies()
+
+    def _save_attr(self, entity, value):
+        """
+        Same as `save_attr()` but does not update the entity's attribute
+        snapshot and flat table row (this is done once by `BaseEntity.save()`).
+        """
         if self.datatype == self.TYPE_MANY:
             self._save_m2m_attr(entity, value)
+            value = sorted(self._clean_choices(value), key=lambda x: x.pk)
         else:
-            self._save_single_attr(entity, value)
+            value = self._save_single_attr(entity, value)
+        invalidate_choices(self.pk)
 
-    def _save_single_attr(self, entity, value=None, schema=None,
-                          create_nulls=False, extra={}):
-        """
-        Creates or updates an EAV attribute for given entity with given value.
+        # keep prefetched values (if any) in sync with the database
+        values = entity.__dict__.get('_attr_values')
+        if values is not None:
+            values[self.name] = value
 
-        :param schema: schema for attribute. Default it current schema instance.
-        :param create_nulls: boolean: if True, even attributes with value=None
-            are created (by default they are skipped).
-        :param extra: dict: additional data for Attr instance (e.g. title).
-        """
-        # If schema is not many-to-one, the value is saved to the corresponding
-        # Attr instance (which is created or updated).
-
-        schema = schema or self
-        lookups = dict(get_entity_lookups(entity), schema=schema, **extra)
-        try:
-            attr = self.attrs.get(**lookups)
-        except self.attrs.model.DoesNotExist:
-            attr = self.attrs.model(**lookups)
-        if create_nulls or value != attr.value:
-            attr.value = value
-            for k,v in extra.items():
-                setattr(attr, k, v)
-            attr.save()
+    def build_attrs(self, entity, value):
+        """
+        Returns a list of unsaved attribute instances which represent given
+        value of this schema for given entity. The list is empty if the value
+        is empty. Raises TypeError or ValueError if the value is wrong (see
+        `save_attr()`).
+        """
+        lookups = dict(get_entity_lookups(entity), schema=self)
+        if self.datatype == self.TYPE_MANY:
+            return [self.attrs.model(choice=choice, **lookups)
+                    for choice in self._clean_choices(value)]
+        attr = self.value_attrs.model(**lookups)
+        attr.value = value
+        if attr.value is None:
+            # not converted: some fields (e.g. BooleanField) reject None
+            return []
+        # convert the value the same way the database would (e.g. "3" to 3.0)
+        # so that it can be compared with stored values
+        for name in attr.get_value_field_names():
+            field = attr._meta.get_field(name)
+            try:
+                setattr(attr, name, field.to_python(getattr(attr, name)))
+            except ValidationError, e:
+                raise ValueError('Cannot assign "%s" to attribute "%s": %s'
+                                 % (value, self.name, '; '.join(e.messages)))
+        return [] if attr.value is None else [attr]
 
-    def _save_m2m_attr(self, entity, value):
+    def _save_single_attr(self, entity, value=None):
+        """
+        Creates or updates an EAV attribute for given entity with given value.
+        An empty value does not create a new attribute but clears existing one.
+        See `eav.utils.upsert_attrs()` for details. Returns the value as it
+        is stored (or None).
+        """
+        model = self.value_attrs.model
+        attrs = self.build_attrs(entity, value)
+        if attrs:
+            upsert_attrs(model, attrs)
+            return attrs[0].value
+        elif issubclass(model, BaseValueAttribute):
+            # narrow tables do not keep empty rows
+            pks = list(self.get_attrs(entity).values_list('pk', flat=True))
+            if pks:
+                using = router.db_for_write(model)
+                DeleteQuery(model).delete_batch(pks, using=using)
+                transaction.commit_unless_managed(using=using)
+        else:
+            names = model(schema=self).get_value_field_names()
+            self.get_attrs(entity).update(**dict((x, None) for x in names))
+        return None
 
+    def _dump_value(self, value):
+        "Converts given attribute value to JSON-compatible data for snapshots."
+        if self.datatype == self.TYPE_MANY:
+            return [[x.pk, x.title] for x in
+                    sorted(self._clean_choices(value), key=lambda x: x.pk)]
+        if self.datatype == self.TYPE_RANGE:
+            return [float(x) for x in value]
+        if self.datatype == self.TYPE_FLOAT:
+            return float(value)
+        if self.datatype == self.TYPE_DATE:
+            return str(value)[:10]    # date, datetime or ISO string
+        if self.datatype == self.TYPE_BOOLEAN:
+            return bool(value)
+        return unicode(value)
+
+    def _load_value(self, data):
+        """
+        Converts data returned by `_dump_value()` back to attribute value.
+        Choices are restored as unsaved instances with primary key and title.
+        """
+        if self.datatype == self.TYPE_MANY:
+            choice_model = self.attrs.model._meta.get_field('choice').rel.to
+            return [choice_model(pk=pk, title=title, schema=self)
+                    for pk, title in data]
+        if self.datatype == self.TYPE_RANGE:
+            return tuple(data)
+        if self.datatype == self.TYPE_DATE:
+            return date(*[int(x) for x in data.split('-')])
+        return data
+
+    def _clean_choices(self, value):
         if not hasattr(value, '__iter__'):
             value = [value]
 
@@ -165,18 +306,53 @@ class BaseSchema(Model):
             raise TypeError('Cannot assign "%s": "Attr.choice" '
                             'must be a BaseChoice instance.'
                             % ', '.join(value))
+        return value
+
+    def _save_m2m_attr(self, entity, value):
 
-        # drop all attributes for this entity/schema pair
-        self.get_attrs(entity).delete()
+        value = self._clean_choices(value)
 
-        # Attr instances for corresponding managed m2m schemata are updated
-        for choice in value:
-            self._save_single_attr(
-                entity,
-                schema = self,
-                create_nulls = True,
-                extra = {'choice': choice}
-            )
+        # compare stored choices with new ones
+        attrs = self.get_attrs(entity)
+        rows = list(attrs.values_list('pk', 'choice'))
+        stored = dict((c, pk) for pk, c in rows if c is not None)
+        choices = dict((x.pk, x) for x in value)
+
+        # drop attributes for choices that are not selected anymore (and
+        # legacy rows without a choice); signals are not sent, like for the
+        # other changes made here
+        dropped = [pk for c, pk in stored.items() if c not in choices]
+        dropped += [pk for pk, c in rows if c is None]
+        if dropped:
+            using = router.db_for_write(self.attrs.model)
+            DeleteQuery(self.attrs.model).delete_batch(dropped, using=using)
+            transaction.commit_unless_managed(using=using)
+
+        # add attributes for newly selected choices
+        added = [x for pk, x in choices.items() if pk not in stored]
+        bulk_insert(self.attrs.model, self.build_attrs(entity, added))
+
+
+class AttrSnapshotField(TextField):
+    """
+    Stores a JSON snapshot of entity's EAV attributes. If a `BaseEntity`
+    subclass has such field, attribute values are read from it instead of
+    the attribute table, so accessing them does not hit the database::
+
+        class Fruit(BaseEntity):
+            attr_snapshot = AttrSnapshotField()
+
+    The snapshot is updated when attributes are saved via the entity or
+    schema, when attribute instances are saved or deleted directly and when
+    choices are saved. It is *not* updated by `QuerySet.update()` and such;
+    use the `rebuild_attr_snapshots` management command to fix snapshots in
+    bulk.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('blank', True)
+        kwargs.setdefault('editable', False)
+        super(AttrSnapshotField, self).__init__(*args, **kwargs)
 
 
 class BaseEntity(Model):
@@ -187,15 +363,30 @@ class BaseEntity(Model):
 
     objects = BaseEntityManager()
 
+    # set to True to keep filtered and sortable attributes in a flat table
+    # (see `eav.flat`)
+    flat_table = False
+
     class Meta:
         abstract = True
 
+    @track('entity_save')
     def save(self, force_eav=False, **kwargs):
         """
         Saves entity instance and creates/updates related attribute instances.
 
+        Only those attributes are saved which were assigned and whose values
+        differ from the stored ones.
+
         :param eav: if True (default), EAV attributes are saved along with entity.
         """
+        if self.pk is None and self.__dict__.get('_attr_values') is None:
+            # a new entity cannot have any stored attributes yet
+            self._attr_values = {}
+            field = self._get_snapshot_field()
+            if field and getattr(self, field.attname) is None:
+                setattr(self, field.attname, self._dump_attr_snapshot())
+
         # save entity
         super(BaseEntity, self).save(**kwargs)
 
@@ -208,27 +399,164 @@ class BaseEntity(Model):
 
 
         # create/update EAV attributes
+        changed = False
         for schema in self.get_schemata():
-            value = getattr(self, schema.name, None)
-            schema.save_attr(self, value)
+            if schema.name not in self.__dict__:
+                # the attribute was not assigned, so it could not change
+                continue
+            value = self.__dict__[schema.name]
+            if self._attr_has_changed(schema, value):
+                schema._save_attr(self, value)
+                changed = True
+            # further reads return the stored (i.e. normalized) value
+            del self.__dict__[schema.name]
+        if changed:
+            self._update_attr_copies()
 
     def __getattr__(self, name):
         if not name.startswith('_'):
             if name in self.get_schema_names():
-                schema = self.get_schema(name)
-                attrs = schema.get_attrs(self)
-                if schema.datatype == schema.TYPE_MANY:
-                    return [a.value for a in attrs if a.value]
-                else:
-                    return attrs[0].value if attrs else None
+                return self._get_attr_value(name)
         raise AttributeError('%s does not have attribute named "%s".' %
                              (self._meta.object_name, name))
 
+    @track('attr_read')
+    def _get_attr_value(self, name):
+        schema = self.get_schema(name)
+        default = [] if schema.datatype == schema.TYPE_MANY else None
+        return self._get_attr_values().get(name, default)
+
+    def _get_attr_values(self):
+        """
+        Returns a dictionary of stored EAV attribute values keyed by schema
+        name. The values are fetched with a single query on first access.
+        """
+        values = self.__dict__.get('_attr_values')
+        if values is None:
+            if self.pk is None:
+                values = self._attr_values = {}
+            else:
+                type(self).prefetch_attrs([self])
+                values = self._attr_values
+        return values
+
+    @classmethod
+    def _get_snapshot_field(cls):
+        "Returns the `AttrSnapshotField` of this model or None."
+        for field in cls._meta.fields:
+            if isinstance(field, AttrSnapshotField):
+                return field
+
+    def _dump_attr_snapshot(self, values=None):
+        "Returns given (or current) attribute values serialized to JSON."
+        if values is None:
+            values = self._get_attr_values()
+        data = {}
+        for schema in self.get_schemata():
+            value = values.get(schema.name)
+            if value is not None and value != []:
+                data[str(schema.pk)] = schema._dump_value(value)
+        return simplejson.dumps(data, sort_keys=True)
+
+    def _load_attr_snapshot(self):
+        """
+        Returns attribute values stored in the snapshot field keyed by schema
+        name, or None if there is no snapshot.
+        """
+        field = self._get_snapshot_field()
+        data = field and getattr(self, field.attname)
+        if not data:
+            return None
+        data = simplejson.loads(data)
+        values = {}
+        for schema in self.get_schemata():
+            if str(schema.pk) in data:
+                values[schema.name] = schema._load_value(data[str(schema.pk)])
+        return values
+
+    def _update_attr_copies(self):
+        """
+        Updates denormalized copies of attributes: the snapshot, the flat
+        table row and the search index (if the model has them).
+        """
+        self._update_attr_snapshot()
+        self._update_flat_row()
+        self._update_search_index()
+
+    def _get_fresh_attr_values(self):
+        if self.__dict__.get('_attr_values') is None:
+            # the snapshot may be outdated, so don't trust it
+            type(self).prefetch_attrs([self], snapshot=False)
+        return self._attr_values
+
+    def _update_attr_snapshot(self):
+        "Saves current attribute values to the snapshot field (if any)."
+        field = self._get_snapshot_field()
+        if field is None or self.pk is None:
+            return
+        data = self._dump_attr_snapshot(self._get_fresh_attr_values())
+        setattr(self, field.attname, data)
+        type(self)._base_manager.filter(pk=self.pk).update(**{field.name: data})
+
+    def _update_flat_row(self):
+        "Saves current attribute values to the flat table (if any)."
+        table = get_flat_table(type(self))
+        if table is None or self.pk is None:
+            return
+        table.update_row(self.pk, self._get_fresh_attr_values())
+
+    def _update_search_index(self):
+        "Saves current terms of searched attributes to the index (if any)."
+        index = get_search_index(type(self))
+        if index is None or self.pk is None:
+            return
+        index.update_row(self.pk, self._get_fresh_attr_values())
+
+    def refresh_attr_snapshot(self):
+        """
+        Re-reads attributes from the database and updates the snapshot. Useful
+        if attributes were modified bypassing the EAV machinery.
+        """
+        self._attr_values = None
+        self._update_attr_snapshot()
+
+    def _attr_has_changed(self, schema, value):
+        """
+        Returns True if given value differs from the stored value of attribute
+        for given schema.
+        """
+        stored = self._get_attr_values().get(schema.name)
+        if schema.datatype == schema.TYPE_MANY:
+            if not hasattr(value, '__iter__'):
+                value = [value]
+            try:
+                new_pks = set(x.pk for x in value)
+            except AttributeError:
+                # not a list of choices; let save_attr() complain
+                return True
+            return new_pks != set(x.pk for x in stored or [])
+        return value != stored
+
     def __iter__(self):
         "Iterates over non-empty EAV attributes. Normal fields are not included."
-        for attr in self.attrs.select_related():
-            if getattr(self, attr.schema.name, None):
-                yield attr
+        if self._load_attr_snapshot() is None:
+            attrs = [self.attrs.select_related()]
+            lookups = get_entity_lookups(self)
+            for model in self._get_value_models():
+                attrs.append(model._default_manager.filter(**lookups)
+                                                   .select_related())
+            for attr in chain(*attrs):
+                if getattr(self, attr.schema.name, None):
+                    yield attr
+            return
+
+        # build attributes from the snapshot; they are not saved
+        for schema in sorted(self.get_schemata(), key=lambda x: x.pk):
+            value = getattr(self, schema.name, None)
+            if value:
+                for attr in schema.build_attrs(self, value):
+                    attr.entity = self
+                    yield attr
 
     @classmethod
     def get_schemata_for_model(cls):
@@ -239,13 +567,81 @@ class BaseEntity(Model):
     def get_schemata_for_instance(self, qs):
         return qs
 
+    @classmethod
+    def _get_value_models(cls):
+        "Returns narrow attribute models used by schemata of this model."
+        return cls.get_schemata_for_model().model.get_value_models()
+
+    @classmethod
+    def prefetch_attrs(cls, entities, snapshot=True):
+        """
+        Fetches EAV attributes for given entity instances with a single query
+        and stores their values in the instances, so that subsequent access to
+        the attributes does not hit the database. Schemata are fetched once
+        for all instances, too. Usage::
+
+            products = list(Product.objects.filter(rubric=1)[:50])
+            Product.prefetch_attrs(products)
+
+        See also `EntityQuerySet.with_attrs()`.
+
+        Instances which have an attribute snapshot (see `AttrSnapshotField`)
+        are not queried unless `snapshot` is False.
+        """
+        entities = [e for e in entities if e.pk is not None]
+        if not entities:
+            return
+
+        all_schemata = registry.get_queryset(cls)
+        pending = []
+        for entity in entities:
+            if getattr(entity, '_schemata_cache', None) is None:
+                entity._cache_schemata(all_schemata)
+            values = entity._load_attr_snapshot() if snapshot else None
+            if values is None:
+                values = {}
+                pending.append(entity)
+            entity._attr_values = values
+        entities = pending
+        if not entities:
+            return
+
+        by_pk = dict((e.pk, e) for e in entities)
+        lookups = get_entity_lookups(entities[0])
+        lookups = {'entity_type': lookups['entity_type'],
+                   'entity_id__in': by_pk.keys()}
+        attrs = entities[0].attrs.model.objects.filter(**lookups)
+        for attr in attrs.select_related('schema', 'choice'):
+            values = by_pk[attr.entity_id]._attr_values
+            schema = attr.schema
+            if schema.datatype == schema.TYPE_MANY:
+                if attr.choice_id:
+                    values.setdefault(schema.name, []).append(attr.value)
+            else:
+                values[schema.name] = attr.value
+
+        # narrow tables (if any) are queried one by one
+        for model in cls._get_value_models():
+            attrs = model._default_manager.filter(**lookups)
+            for attr in attrs.select_related('schema'):
+                by_pk[attr.entity_id]._attr_values[attr.schema.name] = attr.value
+
+        # many-to-one values are ordered the same way choices were defined
+        for entity in entities:
+            for choices in entity._attr_values.values():
+                if isinstance(choices, list):
+                    choices.sort(key=lambda x: x.pk)
+
     def get_schemata(self):
         if hasattr(self, '_schemata_cache') and self._schemata_cache is not None:
             return self._schemata_cache
-        all_schemata = self.get_schemata_for_model().select_related()
+        all_schemata = registry.get_queryset(type(self))
+        self._cache_schemata(all_schemata)
+        return self._schemata_cache
+
+    def _cache_schemata(self, all_schemata):
         self._schemata_cache = self.get_schemata_for_instance(all_schemata)
         self._schemata_cache_dict = dict((s.name, s) for s in self._schemata_cache)
-        return self._schemata_cache
 
     def get_schema_names(self):
         if not hasattr(self, '_schemata_cache_dict'):
@@ -317,6 +713,10 @@ class BaseAttribute(Model):
     schema = NotImplemented    # must be FK
     choice = NotImplemented    # must be nullable FK
 
+    # datatypes (or True for all) to create composite indexes for on syncdb,
+    # see `eav.indexes`
+    value_indexes = ()
+
     class Meta:
         abstract = True
         verbose_name, verbose_name_plural = _('attribute'), _('attributes')
@@ -326,6 +726,14 @@ class BaseAttribute(Model):
     def __unicode__(self):
         return u'%s: %s "%s"' % (self.entity, self.schema.title, self.value)
 
+    def get_value_field_names(self):
+        "Returns names of fields which store the value of this attribute."
+        if self.schema.datatype == self.schema.TYPE_MANY:
+            return ['choice']
+        if self.schema.datatype == self.schema.TYPE_RANGE:
+            return ['value_range_min', 'value_range_max']
+        return ['value_%s' % self.schema.datatype]
+
     def _get_value(self):
         if self.schema.datatype == self.schema.TYPE_MANY:
             return self.choice
@@ -354,6 +762,126 @@ class BaseAttribute(Model):
     value = property(_get_value, _set_value)
 
 
+class BaseValueAttribute(Model):
+    """
+    An attribute stored in a narrow table which only has columns for a single
+    datatype. Unlike `BaseAttribute`, the table has no empty value columns
+    and no empty rows, so it and its indexes are much smaller. Narrow tables
+    are opt-in per datatype; the values of other datatypes (including
+    many-to-one) are still stored in `attrs`::
+
+        class Schema(BaseSchema):
+            value_relations = {'float': 'float_attrs', 'date': 'date_attrs'}
+
+        class FloatAttr(BaseFloatAttribute):
+            schema = models.ForeignKey(Schema, related_name='float_attrs')
+
+        class DateAttr(BaseDateAttribute):
+            schema = models.ForeignKey(Schema, related_name='date_attrs')
+
+    Value fields are named the same way as in `BaseAttribute`, so lookups,
+    facets and flat tables work with both kinds of tables. Note that narrow
+    attributes of deleted entities are deleted via a signal rather than a
+    generic relation.
+    """
+    entity_type = ForeignKey(ContentType)
+    entity_id = IntegerField()
+    entity = generic.GenericForeignKey(ct_field="entity_type", fk_field='entity_id')
+
+    schema = NotImplemented    # must be FK
+
+    datatype = NotImplemented
+    value_fields = ()
+
+    # narrow tables are meant for filtering, so the composite index for the
+    # datatype is created by default (see `eav.indexes`)
+    value_indexes = True
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('attribute'), _('attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+        unique_together = ('entity_type', 'entity_id', 'schema')
+
+    def __unicode__(self):
+        return u'%s: %s "%s"' % (self.entity, self.schema.title, self.value)
+
+    def get_value_field_names(self):
+        "Returns names of fields which store the value of this attribute."
+        return list(self.value_fields)
+
+    def _get_value(self):
+        return getattr(self, self.value_fields[0])
+
+    def _set_value(self, new_value):
+        setattr(self, self.value_fields[0], new_value)
+
+    value = property(_get_value, _set_value)
+
+
+class BaseTextAttribute(BaseValueAttribute):
+    value_text = TextField()
+
+    datatype = BaseSchema.TYPE_TEXT
+    value_fields = ('value_text',)
+
+    class Meta(BaseValueAttribute.Meta):
+        abstract = True
+
+
+class BaseFloatAttribute(BaseValueAttribute):
+    value_float = FloatField()
+
+    datatype = BaseSchema.TYPE_FLOAT
+    value_fields = ('value_float',)
+
+    class Meta(BaseValueAttribute.Meta):
+        abstract = True
+
+
+class BaseDateAttribute(BaseValueAttribute):
+    value_date = DateField()
+
+    datatype = BaseSchema.TYPE_DATE
+    value_fields = ('value_date',)
+
+    class Meta(BaseValueAttribute.Meta):
+        abstract = True
+
+
+class BaseBooleanAttribute(BaseValueAttribute):
+    value_bool = BooleanField()
+
+    datatype = BaseSchema.TYPE_BOOLEAN
+    value_fields = ('value_bool',)
+
+    class Meta(BaseValueAttribute.Meta):
+        abstract = True
+
+
+class BaseRangeAttribute(BaseValueAttribute):
+    value_range_min = FloatField()
+    value_range_max = FloatField()
+
+    datatype = BaseSchema.TYPE_RANGE
+    value_fields = ('value_range_min', 'value_range_max')
+
+    class Meta(BaseValueAttribute.Meta):
+        abstract = True
+
+    def _get_value(self):
+        value = (self.value_range_min, self.value_range_max)
+        return None if value == (None, None) else value
+
+    def _set_value(self, new_value):
+        new_value = new_value or (None, None)
+        validate_range_value(new_value)
+        for k, v in zip(('min', 'max'), new_value):
+            setattr(self, 'value_range_%s' % k, v if v is None else float(v))
+
+    value = property(_get_value, _set_value)
+
+
 def validate_range_value(value):
     """
     Validates given value against `Schema.TYPE_RANGE` data type. Raises
@@ -377,4 +905,151 @@ def validate_range_value(value):
     return
 
 
-# xxx catch signal Attr.post_save() --> update attr.item.attribute_cache (JSONField or such)
+def invalidate_schemata(sender, **kwargs):
+    "Drops cached schemata when any schema is saved or deleted."
+    if issubclass(sender, BaseSchema):
+        registry.invalidate()
+
+post_save.connect(invalidate_schemata, dispatch_uid='eav_invalidate_schemata')
+post_delete.connect(invalidate_schemata, dispatch_uid='eav_invalidate_schemata')
+
+
+def create_attr_indexes(sender, created_models, db=None, **kwargs):
+    """
+    Creates extra indexes for newly created attribute tables, and flat tables
+    and search indexes for newly created entity tables.
+    """
+    for model in created_models:
+        if issubclass(model, BaseAttribute):
+            create_single_attr_index(model, using=db)
+            create_value_indexes(model, using=db)
+        elif issubclass(model, BaseValueAttribute):
+            create_value_indexes(model, using=db)
+        elif issubclass(model, BaseEntity):
+            if get_flat_table(model):
+                get_flat_table(model).sync(using=db)
+            if get_search_index(model):
+                get_search_index(model).sync(using=db)
+
+post_syncdb.connect(create_attr_indexes, dispatch_uid='eav_create_attr_indexes')
+post_syncdb.connect(reset_upsert_cache, dispatch_uid='eav_reset_upsert_cache')
+
+
+def refresh_attr_copies(sender, instance, **kwargs):
+    """
+    Updates entity's attribute snapshot, flat table row and search index when
+    an attribute is saved or deleted.
+    """
+    if not issubclass(sender, (BaseAttribute, BaseValueAttribute)):
+        return
+    model = ContentType.objects.get_for_id(instance.entity_type_id).model_class()
+    if not (model and issubclass(model, BaseEntity) and
+            (model._get_snapshot_field() or get_flat_table(model) or
+             get_search_index(model))):
+        return
+    try:
+        entity = model._base_manager.get(pk=instance.entity_id)
+    except model.DoesNotExist:
+        return
+    entity._update_attr_copies()
+
+post_save.connect(refresh_attr_copies, dispatch_uid='eav_refresh_attr_copies')
+post_delete.connect(refresh_attr_copies, dispatch_uid='eav_refresh_attr_copies')
+
+
+def refresh_choice_snapshots(sender, instance, created=False, **kwargs):
+    """
+    Updates attribute snapshots of entities which have given choice when the
+    choice is saved (e.g. renamed). Snapshots of entities whose choices are
+    deleted are updated via their attributes.
+    """
+    if not issubclass(sender, BaseChoice) or created:
+        return
+    attrs = instance.schema.attrs.filter(choice=instance)
+    ids = {}
+    for ctype_id, entity_id in attrs.values_list('entity_type', 'entity_id'):
+        ids.setdefault(ctype_id, []).append(entity_id)
+    for ctype_id, entity_ids in ids.items():
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+        if not (model and issubclass(model, BaseEntity) and
+                model._get_snapshot_field()):
+            continue
+        entities = list(model._base_manager.filter(pk__in=entity_ids))
+        model.prefetch_attrs(entities, snapshot=False)
+        for entity in entities:
+            entity._update_attr_snapshot()
+
+post_save.connect(refresh_choice_snapshots, dispatch_uid='eav_refresh_choice_snapshots')
+
+
+def invalidate_schema_choices(sender, instance, **kwargs):
+    "Drops cached facet choices when an attribute or choice is saved or deleted."
+    if issubclass(sender, (BaseAttribute, BaseValueAttribute, BaseChoice)):
+        invalidate_choices(instance.schema_id)
+
+post_save.connect(invalidate_schema_choices, dispatch_uid='eav_invalidate_schema_choices')
+post_delete.connect(invalidate_schema_choices, dispatch_uid='eav_invalidate_schema_choices')
+
+
+def sync_flat_tables(sender, instance, **kwargs):
+    "Adds flat table columns for schemata which became filtered or sortable."
+    if not issubclass(sender, BaseSchema):
+        return
+    for model in get_models():
+        table = issubclass(model, BaseEntity) and get_flat_table(model)
+        if not table or model.get_schemata_for_model().model is not sender:
+            # the entity model uses another schema model
+            continue
+        if table.exists():
+            table.sync()
+
+post_save.connect(sync_flat_tables, dispatch_uid='eav_sync_flat_tables')
+
+
+def delete_flat_row(sender, instance, **kwargs):
+    "Deletes the flat table row of a deleted entity."
+    if issubclass(sender, BaseEntity) and get_flat_table(sender):
+        get_flat_table(sender).delete_row(instance.pk)
+
+post_delete.connect(delete_flat_row, dispatch_uid='eav_delete_flat_row')
+
+
+def sync_search_indexes(sender, instance, **kwargs):
+    "Indexes or unindexes attributes of a schema which became (not) searched."
+    if not issubclass(sender, BaseSchema):
+        return
+    for model in get_models():
+        index = issubclass(model, BaseEntity) and get_search_index(model)
+        if index and model.get_schemata_for_model().model is sender:
+            index.sync_schema(instance)
+
+post_save.connect(sync_search_indexes, dispatch_uid='eav_sync_search_indexes')
+
+
+def delete_search_rows(sender, instance, **kwargs):
+    "Deletes index rows of a deleted entity or schema."
+    if issubclass(sender, BaseEntity) and get_search_index(sender):
+        get_search_index(sender).delete_row(instance.pk)
+    elif issubclass(sender, BaseSchema):
+        for model in get_models():
+            index = issubclass(model, BaseEntity) and get_search_index(model)
+            if index and model.get_schemata_for_model().model is sender:
+                index.delete_schema(instance.pk)
+
+post_delete.connect(delete_search_rows, dispatch_uid='eav_delete_search_rows')
+
+
+def delete_value_attrs(sender, instance, **kwargs):
+    "Deletes attributes of a deleted entity from narrow tables (if any)."
+    if not issubclass(sender, BaseEntity):
+        return
+    lookups = get_entity_lookups(instance)
+    for model in sender._get_value_models():
+        pks = list(model._default_manager.filter(**lookups)
+                                         .values_list('pk', flat=True))
+        if pks:
+            using = router.db_for_write(model)
+            DeleteQuery(model).delete_batch(pks, using=using)
+            transaction.commit_unless_managed(using=using)
+
+post_delete.connect(delete_value_attrs, dispatch_uid='eav_delete_value_attrs')
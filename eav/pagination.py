@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Keyset pagination for facet sets. Instead of skipping rows with OFFSET (which
+gets slower with each page), every page starts right after the last entity of
+the previous one, so deep pages cost the same as the first one::
+
+    paginator = KeysetPaginator(facet_set, per_page=20)
+    page = paginator.page(request.GET.get('after'))
+    for item in page:
+        ...
+    if page.has_next():
+        next_url = '?after=%s' % page.next_cursor
+
+Results are ordered by the sort attribute of the facet set (see
+`BaseFacetSet.get_sort_key()`) and then by primary key; entities without a
+value go last or first (see `BaseFacetSet.sort_nulls`). Only "next page" links
+can be built this way. If the sort attribute cannot be selected by an SQL
+expression (e.g. it is a foreign key), the pages fall back to offsets.
+"""
+
+# python
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+# django
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.db.models.query import EmptyQuerySet
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+
+
+__all__ = ['KeysetPage', 'KeysetPaginator']
+
+
+def encode_cursor(*key):
+    return urlsafe_b64encode(simplejson.dumps(key, default=unicode))
+
+
+def decode_cursor(cursor, length):
+    try:
+        key = simplejson.loads(urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise InvalidPage('Wrong cursor "%s".' % cursor)
+    if not isinstance(key, list) or len(key) != length:
+        raise InvalidPage('Wrong cursor "%s".' % cursor)
+    return key
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __repr__(self):
+        return '<KeysetPage: %d items>' % len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+class KeysetPaginator(object):
+
+    def __init__(self, facet_set, per_page):
+        self.facet_set = facet_set
+        self.per_page = int(per_page)
+
+    @property
+    def count(self):
+        "Returns the total number of results (see `BaseFacetSet.count_mode`)."
+        return self.facet_set.count()
+
+    def page(self, cursor=None):
+        """
+        Returns the page which follows the entity identified by given cursor
+        (as in `KeysetPage.next_cursor`). Returns the first page if the cursor
+        is empty. Raises `InvalidPage` if the cursor is malformed.
+        """
+        qs = self.facet_set.object_list
+        if isinstance(qs, EmptyQuerySet):
+            return KeysetPage([], None)
+        expr, params, desc = self.facet_set.get_sort_key()
+        if expr is None and self.facet_set.data.get('order_by'):
+            return self._get_offset_page(qs, desc, cursor)
+        qs = self._order(qs, expr, params, desc)
+        if cursor:
+            value, pk = decode_cursor(cursor, 2)
+            qs = self._seek(qs, expr, params, desc, value, pk)
+        items = list(qs[:self.per_page + 1])
+        if len(items) <= self.per_page:
+            return KeysetPage(items, None)
+        items = items[:self.per_page]
+        last = items[-1]
+        return KeysetPage(items, encode_cursor(last.eav_sort_value, last.pk))
+
+    def _get_offset_page(self, qs, desc, cursor):
+        # the facet set has already ordered the results; the primary key
+        # makes the order stable
+        pk = '-pk' if desc else 'pk'
+        ordering = qs.query.extra_order_by or qs.query.order_by
+        qs = qs.extra(order_by=list(ordering) + [pk])
+        offset = 0
+        if cursor:
+            offset, = decode_cursor(cursor, 1)
+            if not isinstance(offset, int) or offset < 0:
+                raise InvalidPage('Wrong cursor "%s".' % cursor)
+        items = list(qs[offset:offset + self.per_page + 1])
+        if len(items) <= self.per_page:
+            return KeysetPage(items, None)
+        return KeysetPage(items[:self.per_page],
+                          encode_cursor(offset + self.per_page))
+
+    def _get_pk_column(self, qs):
+        qn = connections[qs.db].ops.quote_name
+        opts = qs.model._meta
+        return '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+
+    def _order(self, qs, expr, params, desc):
+        direction = '-' if desc else ''
+        nulls_first = self.facet_set.sort_nulls == 'first'
+        if expr is None:
+            expr = 'NULL'
+        select = SortedDict([
+            ('eav_sort_null', '%s IS NULL' % expr),
+            ('eav_sort_value', expr),
+        ])
+        return qs.extra(select=select, select_params=params + params,
+                        order_by=[('-' if nulls_first else '') + 'eav_sort_null',
+                                  direction + 'eav_sort_value',
+                                  direction + 'pk'])
+
+    def _seek(self, qs, expr, params, desc, value, pk):
+        op = '<' if desc else '>'
+        pk_column = self._get_pk_column(qs)
+        nulls_first = self.facet_set.sort_nulls == 'first'
+        if expr is None or value is None:
+            # entities without a value are ordered by primary key
+            expr = expr or 'NULL'
+            where = '(%s IS NULL AND %s %s %%s)' % (expr, pk_column, op)
+            if nulls_first:
+                where = '(%s OR %s IS NOT NULL)' % (where, expr)
+                return qs.extra(where=[where], params=params + [pk] + params)
+            return qs.extra(where=[where], params=params + [pk])
+        where = ('(%(e)s %(op)s %%s OR '
+                 '(%(e)s = %%s AND %(pk)s %(op)s %%s))' % {
+                     'e': expr, 'op': op, 'pk': pk_column})
+        where_params = params + [value] + params + [value, pk]
+        if not nulls_first:
+            where = '(%s IS NULL OR %s)' % (expr, where)
+            where_params = params + where_params
+        return qs.extra(where=[where], params=where_params)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+A process-wide registry of schemata. Schemata are fetched once per entity
+model and kept in memory until any schema is saved or deleted.
+
+Several processes (e.g. web server workers) share a version number stored via
+Django cache framework: when one process invalidates the registry, others
+notice the new version and re-fetch schemata on next access. If the cache
+backend is not shared between processes (or is a dummy one), only the process
+which actually modified a schema is guaranteed to see the changes at once.
+
+Note that `QuerySet.update()` does not send any signals, so the registry must
+be invalidated manually in such cases::
+
+    from eav.registry import registry
+    registry.invalidate()
+
+"""
+
+# python
+import time
+
+# django
+from django.core.cache import cache
+
+
+__all__ = ['SchemaRegistry', 'registry']
+
+
+class SchemaRegistry(object):
+
+    version_key = 'eav_schemata_version'
+
+    def __init__(self):
+        self._entries = {}
+
+    def _get_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            # use current time so that the number never goes back if the key
+            # is evicted from the cache
+            cache.add(self.version_key, int(time.time() * 1000))
+            version = cache.get(self.version_key)
+        return version
+
+    @property
+    def version(self):
+        "Changes whenever any schema is saved or deleted."
+        return self._get_version()
+
+    def _get_entry(self, model):
+        version = self._get_version()
+        entry = self._entries.get(model)
+        if entry is None or entry[0] != version:
+            schemata = list(model.get_schemata_for_model().select_related())
+            by_name = dict((s.name, s) for s in schemata)
+            entry = self._entries[model] = (version, schemata, by_name)
+        return entry
+
+    def get_schemata(self, model):
+        "Returns a list of schemata for given entity model."
+        return self._get_entry(model)[1]
+
+    def get_schemata_dict(self, model):
+        "Returns a dictionary of schemata for given entity model keyed by name."
+        return self._get_entry(model)[2]
+
+    def get_queryset(self, model):
+        """
+        Returns the model's QuerySet for schemata with results already in
+        place, i.e. iterating over it does not hit the database (while further
+        filtering does).
+        """
+        qs = model.get_schemata_for_model().select_related()
+        qs._result_cache = list(self.get_schemata(model))
+        return qs
+
+    def invalidate(self):
+        "Drops cached schemata in this and (via cache) all other processes."
+        self._entries.clear()
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            # the key is missing, it will be set on next access
+            pass
+
+
+registry = SchemaRegistry()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Full-text search over text attributes of schemata marked as `searched`. If an
+entity model sets `search_index = True`, an inverted index (a table of terms,
+schemata and entities) is kept along with the attribute table::
+
+    class Fruit(BaseEntity):
+        search_index = True
+
+    Fruit.objects.search('green apple')
+    Fruit.objects.filter(price__lt=5).search('apple').with_attrs()
+
+Search returns entities which have all words of the query in their searched
+attributes; words are matched as a whole and case-insensitively. The result
+is an ordinary entity queryset, so it can be filtered, sorted and used by
+facet sets which enable it (see `BaseFacetSet.search_param`).
+
+Rows are updated when attributes are saved via `BaseEntity.save()` or
+`BaseSchema.save_attr()`, and when a schema is saved (so that the attributes
+of a schema which became searched are indexed at once). Like with flat tables
+(see `eav.flat`), `QuerySet.update()` does not keep the index in sync; use
+the `rebuild_search_index` management command in such cases.
+
+Models without the index are searched with ``icontains`` lookups, which is
+slow on large tables and matches parts of words as well (e.g. "app" finds
+"apple"), so enabling the index may narrow down the results.
+"""
+
+# python
+import re
+
+# django
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import CharField, IntegerField
+
+# this app
+from registry import registry
+
+
+__all__ = ['SearchIndex', 'get_search_index', 'get_terms']
+
+
+# maximum length of an indexed word; longer words are truncated
+TERM_LENGTH = 100
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# entity model --> SearchIndex instance (or None if the model has no index)
+_indexes = {}
+
+
+def get_search_index(model):
+    "Returns the `SearchIndex` for given entity model or None if it has none."
+    if model not in _indexes:
+        enabled = getattr(model, 'search_index', False)
+        _indexes[model] = SearchIndex(model) if enabled else None
+    return _indexes[model]
+
+
+def get_terms(text):
+    "Returns a sorted list of unique lowercase words found in given text."
+    words = WORD_RE.findall(unicode(text or '').lower())
+    return sorted(set(x[:TERM_LENGTH] for x in words))
+
+
+class SearchSubquery(object):
+    """
+    Selects primary keys of entities which have all given terms in the index.
+    Can be used as a value in lookups like ``pk__in``.
+    """
+    value_annotation = True
+
+    def __init__(self, index, terms):
+        self.index = index
+        self.terms = terms
+
+    def _prepare(self):
+        return self
+
+    def _as_sql(self, connection):
+        qn = connection.ops.quote_name
+        sql = 'SELECT %s FROM %s WHERE %s IN (%s)' % (
+            qn('entity_id'), qn(self.index.db_table), qn('term'),
+            ', '.join(['%s'] * len(self.terms)))
+        if len(self.terms) > 1:
+            sql += ' GROUP BY %s HAVING COUNT(DISTINCT %s) = %d' % (
+                qn('entity_id'), qn('term'), len(self.terms))
+        return sql, list(self.terms)
+
+
+class SearchIndex(object):
+
+    def __init__(self, model):
+        self.model = model
+        self.db_table = '%s_search' % model._meta.db_table
+        self._exists = {}    # db alias --> True if the table exists
+
+    def _get_connection(self, using=None):
+        return connections[using or router.db_for_write(self.model)]
+
+    def get_schemata(self):
+        "Returns schemata which should be indexed."
+        return [s for s in registry.get_schemata(self.model)
+                if self.is_indexed(s)]
+
+    def is_indexed(self, schema):
+        return schema.searched and schema.datatype == schema.TYPE_TEXT
+
+    def exists(self, using=None):
+        "Returns True if the table exists in the database."
+        connection = self._get_connection(using)
+        if connection.alias not in self._exists:
+            cursor = connection.cursor()
+            tables = connection.introspection.get_table_list(cursor)
+            self._exists[connection.alias] = self.db_table in tables
+        return self._exists[connection.alias]
+
+    def sync(self, using=None):
+        """
+        Creates the table if it does not exist yet and indexes attributes of
+        searched schemata which are not indexed yet.
+        """
+        connection = self._get_connection(using)
+        qn = connection.ops.quote_name
+        self._exists.pop(connection.alias, None)
+        if not self.exists(connection.alias):
+            cursor = connection.cursor()
+            integer_type = IntegerField().db_type(connection=connection)
+            cursor.execute('CREATE TABLE %s (%s %s NOT NULL, %s %s NOT NULL, '
+                           '%s %s NOT NULL, PRIMARY KEY (%s, %s, %s))' % (
+                qn(self.db_table),
+                qn('term'),
+                CharField(max_length=TERM_LENGTH).db_type(connection=connection),
+                qn('schema_id'), integer_type,
+                qn('entity_id'), integer_type,
+                qn('term'), qn('schema_id'), qn('entity_id')))
+            name = truncate_name('%s_entity_id' % self.db_table,
+                                 connection.ops.max_name_length())
+            cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+                qn(name), qn(self.db_table), qn('entity_id')))
+            self._exists[connection.alias] = True
+        for schema in registry.get_schemata(self.model):
+            self.sync_schema(schema, using=connection.alias)
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def sync_schema(self, schema, using=None):
+        """
+        Indexes attributes of given schema if it is searched but not indexed
+        yet, or drops its rows if it is not searched anymore. Does nothing if
+        the table does not exist.
+        """
+        connection = self._get_connection(using)
+        if not self.exists(connection.alias):
+            return
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1 FROM %s WHERE %s = %%s' % (
+            qn(self.db_table), qn('schema_id')), [schema.pk])
+        indexed = cursor.fetchone() is not None
+        if indexed == self.is_indexed(schema):
+            return
+        if indexed:
+            self.delete_schema(schema.pk, using=connection.alias)
+            return
+        ctype = ContentType.objects.get_for_model(self.model)
+        attrs = schema.value_attrs.filter(entity_type=ctype, schema=schema,
+                                          value_text__isnull=False)
+        rows = []
+        for entity_id, text in attrs.values_list('entity_id', 'value_text'):
+            rows.extend((x, schema.pk, entity_id) for x in get_terms(text))
+        self._insert(connection, rows)
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def drop(self, using=None):
+        "Drops the table (if it exists)."
+        connection = self._get_connection(using)
+        if self.exists(connection.alias):
+            cursor = connection.cursor()
+            cursor.execute('DROP TABLE %s' % connection.ops.quote_name(self.db_table))
+            transaction.commit_unless_managed(using=connection.alias)
+        self._exists.pop(connection.alias, None)
+
+    def rebuild(self, using=None):
+        "Re-creates the table from scratch."
+        self.drop(using)
+        self.sync(using)
+
+    def _get_rows(self, entity_id, values):
+        rows = []
+        for schema in self.get_schemata():
+            for term in get_terms(values.get(schema.name)):
+                rows.append((term, schema.pk, entity_id))
+        return rows
+
+    def _insert(self, connection, rows):
+        if not rows:
+            return
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)'
+                           % (qn(self.db_table), qn('term'), qn('schema_id'),
+                              qn('entity_id')), rows)
+
+    def update_row(self, entity_id, values, using=None):
+        """
+        Replaces index rows of given entity with terms found in given
+        attribute values (a dictionary keyed by schema name).
+        """
+        connection = self._get_connection(using)
+        if not self.exists(connection.alias):
+            return
+        self.delete_row(entity_id, using=connection.alias)
+        self._insert(connection, self._get_rows(entity_id, values))
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def insert_rows(self, rows, using=None):
+        "Indexes given pairs of entity id and attribute values."
+        connection = self._get_connection(using)
+        if not rows or not self.exists(connection.alias):
+            return
+        index_rows = []
+        for entity_id, values in rows:
+            index_rows.extend(self._get_rows(entity_id, values))
+        self._insert(connection, index_rows)
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def _delete(self, connection, column, value):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s = %%s' % (
+            qn(self.db_table), qn(column)), [value])
+        transaction.commit_unless_managed(using=connection.alias)
+
+    def delete_row(self, entity_id, using=None):
+        connection = self._get_connection(using)
+        if self.exists(connection.alias):
+            self._delete(connection, 'entity_id', entity_id)
+
+    def delete_schema(self, schema_id, using=None):
+        connection = self._get_connection(using)
+        if self.exists(connection.alias):
+            self._delete(connection, 'schema_id', schema_id)
+
+    def get_subquery(self, terms):
+        """
+        Returns a `SearchSubquery` which selects entities with all given terms
+        (see `get_terms()`).
+        """
+        return SearchSubquery(self, terms)
@@ -121,6 +121,48 @@ ValueError: Range must consist of min and max values (min <= max) but got "3" an
 >>> Entity.objects.filter(weight_range__overlaps=(-5, 1))
 [<Entity: Apple>]
 
+# ranges can also be matched if they include given number or range, lie
+# within given range or are equal to it
+
+>>> Entity.objects.filter(weight_range__contains=2)
+[<Entity: Apple>]
+>>> Entity.objects.filter(weight_range__contains=3.5)
+[]
+>>> Entity.objects.filter(weight_range__contains=(1, 2))
+[<Entity: Apple>]
+>>> Entity.objects.filter(weight_range__contains=(0, 2))
+[]
+>>> Entity.objects.filter(weight_range__within=(0, 3))
+[<Entity: Apple>]
+>>> Entity.objects.filter(weight_range__within=(2, None))
+[]
+>>> Entity.objects.filter(weight_range__equals=(1, 3))
+[<Entity: Apple>]
+>>> Entity.objects.filter(weight_range__equals=(1, 4))
+[]
+>>> Entity.objects.filter(weight_range__touches=(1, 4))
+Traceback (most recent call last):
+...
+ValueError: Range schema only supports lookups "overlaps", "contains", "within", "equals".
+
+# lower bounds of matching ranges are limited by the length of the longest
+# stored range, so that the range index can be used; the length is selected
+# by the query itself, so ranges changed behind the EAV machinery still match
+
+>>> qs = Entity.objects.filter(weight_range__contains=3)
+>>> 'MAX(eav_span' in str(qs.query)
+True
+>>> Attr.objects.filter(schema=weight_range).update(value_range_min=-10)
+1
+>>> Entity.objects.filter(weight_range__contains=-9)
+[<Entity: Apple>]
+>>> Entity.objects.filter(weight_range__overlaps=(2.5, None))
+[<Entity: Apple>]
+>>> Attr.objects.filter(schema=weight_range).update(value_range_min=1)
+1
+>>> Entity.objects.filter(weight_range__contains=-9)
+[]
+
 
 ##
 ## many-to-one
@@ -195,6 +237,164 @@ TypeError: Cannot assign "wrong choice": "Attr.choice" must be a BaseChoice inst
 >>> Entity.objects.filter(size=large) & Entity.objects.filter(colour='orange')
 [<Entity: Old Dog>]
 
+#
+# EAV lookups are resolved with subqueries, not joins, so there are no duplicates
+#
+>>> 'JOIN' in str(Entity.objects.filter(colour='orange', size__in=[small, large]).query)
+False
+>>> Entity.objects.filter(size__in=[small, medium, large]).count()
+4
+
+#
+# EAV lookups can be combined using EavQ objects
+#
+>>> from django.db.models import Q
+>>> from eav.managers import EavQ
+>>> Entity.objects.filter(EavQ(colour='yellow') | EavQ(size=large))
+[<Entity: Apple>, <Entity: T-shirt>, <Entity: Old Dog>]
+>>> Entity.objects.filter(EavQ(taste='sweet') & ~EavQ(colour='orange'))
+[<Entity: Apple>]
+>>> Entity.objects.exclude(EavQ(size=small) | EavQ(taste='bitter'))
+[<Entity: Apple>, <Entity: Orange>]
+>>> Entity.objects.all().filter(Q(title='T-shirt') | EavQ(colour='yellow'))
+[<Entity: Apple>, <Entity: T-shirt>]
+
+##
+## prefetching attributes
+##
+
+>>> from django.conf import settings
+>>> from django.db import connection, reset_queries
+>>> settings.DEBUG = True
+>>> reset_queries()
+>>> entities = list(Entity.objects.filter(colour='orange').with_attrs())
+>>> [(e.title, e.taste, e.size) for e in entities]
+[(u'Orange', u'sweet', [<Choice: M>]), (u'Tangerine', u'sweet', [<Choice: S>]), (u'Old Dog', u'bitter', [<Choice: L>])]
+>>> len(connection.queries)    # entities, attributes (schemata are cached)
+2
+
+# attributes are fetched once per instance; only changed ones are saved
+
+>>> e = Entity.objects.get(title='Orange')
+>>> reset_queries()
+>>> e.colour, e.taste, e.size
+(u'orange', u'sweet', [<Choice: M>])
+>>> len(connection.queries)    # attributes
+1
+>>> e.taste = 'sour'
+>>> e.colour = 'orange'
+>>> reset_queries()
+>>> e.save()
+>>> len(connection.queries)    # entity (2), taste (1)
+3
+>>> reset_queries()
+>>> e.save()
+>>> len(connection.queries)    # entity (2)
+2
+>>> Entity.objects.get(title='Orange').taste
+u'sour'
+>>> e.taste = 'sweet'
+>>> e.save()
+
+# assigned values are read back as they are stored
+
+>>> e.age = '3'
+>>> e.weight_range = [1, 3]
+>>> e.save()
+>>> e.age, e.weight_range
+(3.0, (1.0, 3.0))
+>>> reset_queries()
+>>> e.save()
+>>> len(connection.queries)    # entity (2)
+2
+>>> e.age = 'wrong type'
+>>> e.save()
+Traceback (most recent call last):
+...
+ValueError: Cannot assign "wrong type" to attribute "age": ...
+>>> Attr.objects.filter(schema__in=[age, weight_range], entity_id=e.pk).delete()
+
+# single-valued attributes are inserted or updated with a single statement
+
+>>> reset_queries()
+>>> age.save_attr(e, 2)
+>>> age.save_attr(e, 3)
+>>> len(connection.queries)
+2
+>>> Attr.objects.filter(schema=age).values_list('entity_id', 'value_float')
+[(3, 3.0)]
+
+# backends without upsert support update existing attributes or insert new ones
+
+>>> from eav import utils
+>>> can_upsert = utils._can_upsert
+>>> utils._can_upsert = lambda connection, model: False
+>>> age.save_attr(e, 4)
+>>> age.save_attr(Entity.objects.get(title='Apple'), 1)
+>>> Attr.objects.filter(schema=age).values_list('entity_id', 'value_float')
+[(1, 1.0), (3, 4.0)]
+>>> utils._can_upsert = can_upsert
+
+# tables created without the unique index (e.g. by older versions) get it
+# from the eav_indexes command; upserts are used as soon as it exists
+
+>>> from django.core.management import call_command
+>>> connection.cursor().execute('DROP INDEX eav_attr_single_uniq') and None
+>>> utils._upsert_tables.pop((connection.alias, Attr._meta.db_table), None)
+True
+>>> utils._can_upsert(connection, Attr)
+False
+>>> reset_queries()
+>>> age.save_attr(e, 3)
+>>> len(connection.queries)    # update (the index is not looked up again)
+1
+>>> call_command('eav_indexes', 'eav.Attr', create=True)
+eav.Attr: created index eav_attr_single_uniq.
+>>> utils._can_upsert(connection, Attr)
+True
+
+# empty values clear existing attributes
+
+>>> age.save_attr(e, None)
+>>> Attr.objects.filter(schema=age).values_list('entity_id', 'value_float')
+[(1, 1.0), (3, None)]
+
+# multiple choices are saved by difference
+
+>>> reset_queries()
+>>> size.save_attr(e, [medium])
+>>> len(connection.queries)    # stored choices
+1
+>>> reset_queries()
+>>> size.save_attr(e, [medium, large])
+>>> len(connection.queries)    # stored choices, insert
+2
+>>> e.size
+[<Choice: M>, <Choice: L>]
+>>> size.save_attr(e, [medium])
+>>> Entity.objects.get(title='Orange').size
+[<Choice: M>]
+>>> legacy = Attr.objects.create(entity=e, schema=size, choice=None)
+>>> size.save_attr(e, [medium])
+>>> Attr.objects.filter(schema=size, entity_id=e.pk).values_list('choice', flat=True)
+[2]
+
+# schemata are cached until any schema is saved or deleted
+
+>>> from eav.registry import registry
+>>> reset_queries()
+>>> Entity.objects.filter(colour='orange', taste='sweet').count()
+2
+>>> len(connection.queries)
+1
+>>> smell = Schema.objects.create(title='Smell', datatype=Schema.TYPE_TEXT)
+>>> 'smell' in registry.get_schemata_dict(Entity)
+True
+>>> smell.delete()
+>>> 'smell' in registry.get_schemata_dict(Entity)
+False
+>>> settings.DEBUG = False
+
 ##
 ## facets
 ##
@@ -219,6 +419,749 @@ TypeError: Cannot assign "wrong choice": "Attr.choice" must be a BaseChoice inst
 [<Entity: Orange>, <Entity: Tangerine>]
 >>> [x for x in FacetSet({'size': [large.pk]})]
 [<Entity: T-shirt>, <Entity: Old Dog>]
+
+# facets can count matching entities per value with one query per facet
+
+>>> settings.DEBUG = True
+>>> fs = FacetSet({'colour': 'orange'})
+>>> fs.object_list
+[<Entity: Orange>, <Entity: Tangerine>, <Entity: Old Dog>]
+>>> reset_queries()
+>>> counts = fs.facet_counts
+>>> len(connection.queries)
+4
+>>> sorted(counts)
+['colour', 'price', 'size', 'taste']
+>>> counts['colour'], sorted(counts['taste'].items())
+({u'orange': 3}, [(u'bitter', 1), (u'sweet', 2)])
+>>> sorted((Choice.objects.get(pk=k).title, v) for k, v in counts['size'].items())
+[(u'L', 1), (u'M', 1), (u'S', 1)]
+>>> sorted(FacetSet({}).facet_counts['colour'].items())
+[(u'orange', 3), (u'yellow', 1)]
+>>> settings.DEBUG = False
+
+# choices are found among entities of the facet set; they can be narrowed to
+# entities matching other active facets
+
+>>> FacetSet({}).form.fields['taste'].choices
+[('', u'any'), (u'bitter', u'bitter'), (u'sweet', u'sweet')]
+>>> class NarrowFacetSet(FacetSet):
+...     narrow_choices = True
+>>> fs = NarrowFacetSet({'colour': 'yellow'})
+>>> fs.form.fields['taste'].choices
+[('', u'any'), (u'sweet', u'sweet')]
+>>> fs.form.fields['colour'].choices
+[('', u'any'), (u'orange', u'orange'), (u'yellow', u'yellow')]
+>>> fs = NarrowFacetSet({'colour': 'yellow', 'taste': 'bitter'})
+>>> fs.form.fields['taste'].choices
+[('', u'any'), (u'sweet', u'sweet'), ('bitter', 'bitter')]
+>>> fs.form.fields['colour'].choices
+[('', u'any'), (u'orange', u'orange'), ('yellow', 'yellow')]
+>>> list(fs)
+[]
+
+# results can be paginated by keyset instead of offset
+
+>>> from eav.pagination import KeysetPaginator
+>>> def get_pages(data, per_page=2):
+...     paginator = KeysetPaginator(FacetSet(data), per_page)
+...     page = paginator.page()
+...     pages = [page.object_list]
+...     while page.has_next():
+...         page = paginator.page(page.next_cursor)
+...         pages.append(page.object_list)
+...     return pages
+>>> get_pages({})
+[[<Entity: Apple>, <Entity: T-shirt>], [<Entity: Orange>, <Entity: Tangerine>], [<Entity: Old Dog>]]
+>>> Schema.objects.filter(name='taste').update(sortable=True)
+1
+>>> get_pages({'order_by': 'taste'})
+[[<Entity: Old Dog>, <Entity: Apple>], [<Entity: Orange>, <Entity: Tangerine>], [<Entity: T-shirt>]]
+>>> get_pages({'order_by': 'taste', 'order_desc': True}, per_page=3)
+[[<Entity: Tangerine>, <Entity: Orange>, <Entity: Apple>], [<Entity: Old Dog>, <Entity: T-shirt>]]
+>>> get_pages({'order_by': 'price', 'colour': 'orange'})
+[[<Entity: Orange>, <Entity: Tangerine>], [<Entity: Old Dog>]]
+>>> Entity.objects.filter(title='Apple').update(price=5)
+1
+>>> list(FacetSet({'order_by': 'price'})) == sum(get_pages({'order_by': 'price'}), [])
+True
+>>> FacetSet({'order_by': 'price'})[0], FacetSet({'order_by': 'price', 'order_desc': True})[0]
+(<Entity: Apple>, <Entity: Apple>)
+>>> Entity.objects.filter(title='Apple').update(price=None)
+1
+>>> KeysetPaginator(FacetSet({}), 2).page('garbage')
+Traceback (most recent call last):
+...
+InvalidPage: Wrong cursor "garbage".
+
+# entities can be ordered by attributes directly; those without a value are
+# not dropped and go last (or first) regardless of the direction
+
+>>> Entity.objects.order_by_attrs('-taste', 'title')
+[<Entity: Apple>, <Entity: Orange>, <Entity: Tangerine>, <Entity: Old Dog>, <Entity: T-shirt>]
+>>> Entity.objects.order_by_attrs('taste', '-title', nulls='first')
+[<Entity: T-shirt>, <Entity: Old Dog>, <Entity: Tangerine>, <Entity: Orange>, <Entity: Apple>]
+>>> [(x.title, x.colour) for x in Entity.objects.order_by_attrs('colour', '-title')]
+[(u'Tangerine', u'orange'), (u'Orange', u'orange'), (u'Old Dog', u'orange'), (u'Apple', u'yellow'), (u'T-shirt', None)]
+>>> Entity.objects.order_by_attrs('foo')
+Traceback (most recent call last):
+...
+NameError: Cannot order items by attributes: unknown attribute "foo". ...
+>>> Entity.objects.order_by_attrs('taste', nulls='middle')
+Traceback (most recent call last):
+...
+ValueError: Expected "first", "last" or None, got "middle".
+
+# the number of results is counted once; it can also be cached
+
+>>> class CachedCountFacetSet(FacetSet):
+...     count_mode = 'cached'
+>>> settings.DEBUG = True
+>>> fs = FacetSet({})
+>>> reset_queries()
+>>> len(fs), fs.count()
+(5, 5)
+>>> len([x for x in connection.queries if 'COUNT' in x['sql']])
+1
+>>> CachedCountFacetSet({'colour': 'orange'}).count()
+3
+>>> reset_queries()
+>>> CachedCountFacetSet({'colour': 'orange'}).count()
+3
+>>> [x for x in connection.queries if 'COUNT' in x['sql']]
+[]
+>>> settings.DEBUG = False
+>>> class LocalCountFacetSet(CachedCountFacetSet):
+...     def get_queryset(self, **kwargs):
+...         return Entity.objects.filter(title=u'\u044f\u0431\u043b\u043e\u043a\u043e', **kwargs)
+>>> LocalCountFacetSet({}).count()
+0
+
+# lists of choices are cached until attributes of the schema are changed
+
+>>> settings.DEBUG = True
+>>> FacetSet({}).form.fields['taste'].choices
+[('', u'any'), (u'bitter', u'bitter'), (u'sweet', u'sweet')]
+>>> reset_queries()
+>>> form = FacetSet({}).form
+>>> [x for x in connection.queries if 'eav_attr' in x['sql'] or 'eav_choice' in x['sql']]
+[]
+>>> old_dog = Entity.objects.get(title='Old Dog')
+>>> taste.save_attr(old_dog, 'salty')
+>>> FacetSet({}).form.fields['taste'].choices
+[('', u'any'), (u'salty', u'salty'), (u'sweet', u'sweet')]
+>>> taste.save_attr(old_dog, 'bitter')
+>>> settings.DEBUG = False
+
+# form classes are reused while schemata and their choices are unchanged
+# (choices of the "price" field are not cached, so its facet set is not)
+
+>>> class SchemaFacetSet(FacetSet):
+...     filterable_fields = []
+>>> FormClass = SchemaFacetSet({}).form.__class__
+>>> SchemaFacetSet({'colour': 'yellow'}).form.__class__ is FormClass
+True
+>>> FacetSet({}).form.__class__ is FacetSet({}).form.__class__
+False
+>>> taste.save_attr(old_dog, 'salty')
+>>> SchemaFacetSet({}).form.__class__ is FormClass
+False
+>>> taste.save_attr(old_dog, 'bitter')
+
+# dynamic fields of entity forms are built once per set of schemata, too
+
+>>> from eav import forms as eav_forms
+>>> class EntityForm(eav_forms.BaseDynamicEntityForm):
+...     class Meta:
+...         model = Entity
+>>> eav_forms._fields_cache.clear()
+>>> form = EntityForm(instance=old_dog)
+>>> form.initial['taste'], form.initial['size']
+(u'bitter', [3])
+>>> form.fields['taste'] is EntityForm(instance=old_dog).fields['taste']
+False
+>>> form = EntityForm(instance=Entity.objects.get(title='Apple'))
+>>> form.initial['colour']
+u'yellow'
+>>> len(eav_forms._fields_cache)
+1
+>>> xl = size.choices.create(title='XL')
+>>> form = EntityForm(instance=old_dog)
+>>> len(eav_forms._fields_cache)
+2
+>>> [x[1] for x in form.fields['size'].choices]
+[u'L', u'M', u'S', u'XL']
+>>> xl.delete()
+
+# form classes built per request (e.g. by the admin) share the cached fields
+
+>>> from django.forms.models import modelform_factory
+>>> eav_forms._fields_cache.clear()
+>>> factory_forms = [modelform_factory(Entity, form=EntityForm)(instance=old_dog)
+...                  for i in range(3)]
+>>> len(eav_forms._fields_cache)
+1
+>>> factory_forms[0].fields.keys() == factory_forms[2].fields.keys()
+True
+>>> factory_forms[0].initial['size']
+[3]
+
+# attribute values and choices of all schemata are loaded with two queries;
+# rendering the form does not hit the database
+
+>>> settings.DEBUG = True
+>>> eav_forms._fields_cache.clear()
+>>> apple = Entity.objects.get(title='Apple')
+>>> reset_queries()
+>>> html = EntityForm(instance=apple).as_p()
+>>> len(connection.queries)
+2
+>>> reset_queries()
+>>> html = EntityForm(instance=Entity.objects.get(title='Apple')).as_p()
+>>> len(connection.queries)
+2
+>>> settings.DEBUG = False
+
+# extra field options are built by callables which get the schema
+
+>>> from django.forms import SelectMultiple
+>>> class SelectEntityForm(EntityForm):
+...     FIELD_EXTRA = {'many': lambda schema: {'widget': SelectMultiple}}
+>>> form = SelectEntityForm(instance=apple)
+>>> form.fields['size'].widget.__class__.__name__
+'SelectMultiple'
+>>> [x[1] for x in form.fields['size'].choices]
+[u'L', u'M', u'S']
+
+# the admin changelist can display and filter by EAV attributes; attributes
+# of all entities on the page are loaded with a single query
+
+>>> from django.contrib.admin.sites import AdminSite
+>>> from django.http import HttpRequest
+>>> from eav.admin import AttrColumn, BaseEntityAdmin
+>>> class EntityAdmin(BaseEntityAdmin):
+...     list_display = ('title', AttrColumn('colour'), AttrColumn('size'))
+...     eav_list_filter = ('colour', 'size')
+>>> model_admin = EntityAdmin(Entity, AdminSite())
+>>> def get_changelist(**params):
+...     request = HttpRequest()
+...     request.GET = params
+...     ChangeList = model_admin.get_changelist(request)
+...     return ChangeList(request, Entity, model_admin.list_display,
+...                       model_admin.list_display_links,
+...                       model_admin.list_filter, model_admin.date_hierarchy,
+...                       model_admin.search_fields,
+...                       model_admin.list_select_related,
+...                       model_admin.list_per_page,
+...                       model_admin.list_editable, model_admin)
+>>> settings.DEBUG = True
+>>> cl = get_changelist()
+>>> reset_queries()
+>>> columns = [x for x in cl.list_display if isinstance(x, AttrColumn)]
+>>> [[x.title] + [unicode(f(x)) for f in columns] for x in cl.result_list]
+[[u'Old Dog', u'orange', u'L'], [u'Tangerine', u'orange', u'S'], [u'Orange', u'orange', u'M'], [u'T-shirt', u'(None)', u'S, L'], [u'Apple', u'yellow', u'(None)']]
+>>> len(connection.queries)
+2
+>>> [[x['display'] for x in spec.choices(cl)] for spec in cl.filter_specs]
+[[u'All', u'orange (3)', u'yellow (1)'], [u'All', u'L (2)', u'M (1)', u'S (2)']]
+>>> [x['query_string'] for x in cl.filter_specs[0].choices(cl)]
+['?', '?colour=orange', '?colour=yellow']
+>>> get_changelist(colour='orange').result_list
+[<Entity: Old Dog>, <Entity: Tangerine>, <Entity: Orange>]
+>>> get_changelist(colour='orange', size='2').result_list
+[<Entity: Orange>]
+>>> settings.DEBUG = False
+>>> get_changelist(colour__exact='yellow').result_list
+[<Entity: Apple>]
+>>> len(get_changelist(colour__regex='^y').result_list)
+5
+>>> EntityAdmin.eav_list_filter = ('colour', 'smell')
+>>> [spec.title() for spec in get_changelist().filter_specs]
+[u'Colour']
+>>> EntityAdmin.eav_list_filter = ('colour', 'size')
+
+# inline formsets load attributes of all entities with a single query and
+# share form fields between forms
+
+>>> from django.forms.models import inlineformset_factory
+>>> from eav.admin import BaseEntityInlineFormSet
+>>> class PartForm(eav_forms.BaseDynamicEntityForm):
+...     class Meta:
+...         model = Part
+>>> PartFormSet = inlineformset_factory(Entity, Part, form=PartForm,
+...                                     formset=BaseEntityInlineFormSet)
+>>> for title in 'abc':
+...     part = Part.objects.create(parent=old_dog, title=title, colour='black')
+>>> settings.DEBUG = True
+>>> reset_queries()
+>>> formset = PartFormSet(instance=old_dog)
+>>> [form.initial.get('colour') for form in formset.forms]
+[u'black', u'black', u'black', None, None, None]
+>>> len(connection.queries)
+3
+>>> formset.forms[0].fields['size'] is formset.forms[1].fields['size']
+False
+>>> part = Part(parent=old_dog)
+>>> PartForm.get_field_names(part) == PartForm(instance=part).fields.keys()
+True
+>>> settings.DEBUG = False
+
+# results sorted by a foreign key are paginated by offset
+
+>>> part = Part.objects.create(parent=Entity.objects.get(title='Apple'), title='d')
+>>> class PartFacetSet(BaseFacetSet):
+...     def get_queryset(self, **kwargs):
+...         return Part.objects.filter(**kwargs)
+>>> paginator = KeysetPaginator(PartFacetSet({'order_by': 'parent'}), 3)
+>>> page = paginator.page()
+>>> [x.title for x in page], [x.title for x in paginator.page(page.next_cursor)]
+([u'd', u'a', u'b'], [u'c'])
+>>> paginator = KeysetPaginator(PartFacetSet({'order_by': 'parent', 'order_desc': True}), 3)
+>>> page = paginator.page()
+>>> [x.title for x in page], [x.title for x in paginator.page(page.next_cursor)]
+([u'c', u'b', u'a'], [u'd'])
+>>> part.delete()
+
+# lookups by attributes of related entities yield no duplicates
+
+>>> Entity.objects.filter(parts__colour='black')
+[<Entity: Old Dog>]
+>>> Part.objects.all().delete()
+
+##
+## bulk creation
+##
+
+>>> Entity.objects.bulk_create_with_attrs([
+...     {'title': 'Lemon', 'colour': 'yellow', 'taste': 'sour', 'size': [small, medium]},
+...     {'title': 'Lime', 'colour': 'green', 'weight_range': (1, 2)},
+...     {'title': 'Kiwi', 'age': None},
+... ], batch_size=2)
+3
+>>> lemon = Entity.objects.get(title='Lemon')
+>>> lemon.colour, lemon.taste, lemon.size
+(u'yellow', u'sour', [<Choice: S>, <Choice: M>])
+>>> Entity.objects.get(title='Lime').weight_range
+(1.0, 2.0)
+>>> Entity.objects.get(title='Kiwi').attrs.count()
+0
+>>> Entity.objects.filter(size=medium)
+[<Entity: Orange>, <Entity: Lemon>]
+>>> Entity.objects.bulk_create_with_attrs([{'title': 'Durian', 'smell': 'awful'}])
+Traceback (most recent call last):
+...
+NameError: Cannot create Entity: unknown attribute(s) "smell".
+>>> Entity.objects.filter(title='Durian').count()
+0
+
+# batches are not committed if the caller manages the transaction
+
+>>> from django.db import transaction
+>>> transaction.enter_transaction_management()
+>>> transaction.managed(True)
+>>> Entity.objects.bulk_create_with_attrs([{'title': 'Fig'}, {'title': 'Quince'}], batch_size=1)
+2
+>>> transaction.rollback()
+>>> transaction.leave_transaction_management()
+>>> Entity.objects.filter(title__in=['Fig', 'Quince']).count()
+0
+
+##
+## attribute snapshots
+##
+
+>>> settings.DEBUG = True
+>>> Product.objects.create(title='Banana', colour='yellow', size=[large, medium])
+<Product: Banana>
+>>> p = Product.objects.get(title='Banana')
+>>> reset_queries()
+>>> p.colour, p.size, [x for x in p]
+(u'yellow', [<Choice: M>, <Choice: L>], [<Attr: Banana: Colour "yellow">, <Attr: Banana: Size "M">, <Attr: Banana: Size "L">])
+>>> len(connection.queries)    # everything is read from the snapshot
+0
+>>> p.colour = 'green'
+>>> reset_queries()
+>>> p.save()
+>>> len(connection.queries)    # entity (2), colour (1), snapshot (1)
+4
+>>> size.save_attr(p, [small])
+>>> p = Product.objects.with_attrs().get(title='Banana')
+>>> p.colour, p.size
+(u'green', [<Choice: S>])
+
+# attributes saved or deleted directly update the snapshot, too
+
+>>> attr = p.attrs.get(schema=colour)
+>>> attr.value = 'brown'
+>>> attr.save()
+>>> Product.objects.get(title='Banana').colour
+u'brown'
+>>> p.attrs.filter(schema=size).delete()
+>>> Product.objects.get(title='Banana').size
+[]
+
+# choices renamed or deleted later are updated in snapshots
+
+>>> p = Product.objects.get(title='Banana')
+>>> xs = size.choices.create(title='XS')
+>>> size.save_attr(p, [small, xs])
+>>> xs.title = 'XXS'
+>>> xs.save()
+>>> Product.objects.get(title='Banana').size
+[<Choice: S>, <Choice: XXS>]
+>>> xs.delete()
+>>> Product.objects.get(title='Banana').size
+[<Choice: S>]
+>>> size.save_attr(p, [])
+
+# snapshots of bulk-created entities are filled in advance
+
+>>> Product.objects.bulk_create_with_attrs([{'title': 'Mango', 'taste': 'sweet'}])
+1
+>>> Product.objects.get(title='Mango').attr_snapshot == '{"%d": "sweet"}' % taste.pk
+True
+
+# snapshots are not updated on mass updates but can be rebuilt
+
+>>> p.attrs.filter(schema=colour).update(value_text='black')
+1
+>>> Product.objects.get(title='Banana').colour
+u'brown'
+>>> Product.objects.rebuild_attr_snapshots(batch_size=1)
+2
+>>> Product.objects.get(title='Banana').colour
+u'black'
+>>> call_command('rebuild_attr_snapshots', 'eav.Product')
+Product: 2 snapshot(s) rebuilt.
+
+##
+## flat tables
+##
+
+# filtered and sortable attributes are copied to a flat table; its columns
+# are added when schemata are saved, so it must be synced after an update()
+
+>>> from eav.flat import get_flat_table
+>>> Schema.objects.filter(name='weight_range').update(filtered=True)
+1
+>>> registry.invalidate()
+>>> flat = get_flat_table(Product)
+>>> flat.sync()
+>>> [x.name for x in flat.get_schemata()]
+[u'colour', u'taste', u'weight_range']
+>>> Product.objects.create(title='Grape', colour='green', weight_range=(0, 1))
+<Product: Grape>
+>>> Product.objects.filter(colour='black')
+[<Product: Banana>]
+>>> Product.objects.filter(colour__in=['black', 'green'], title__startswith='G')
+[<Product: Grape>]
+>>> Product.objects.filter(taste='sweet', weight_range__overlaps=(1, 2))
+[]
+>>> Product.objects.exclude(colour='black')
+[<Product: Mango>, <Product: Grape>]
+>>> qs = Product.objects.filter(colour='green', weight_range=(None, 3))
+>>> qs
+[<Product: Grape>]
+>>> 'eav_product_flat' in str(qs.query), 'eav_attr' in str(qs.query)
+(True, False)
+
+# the attributes table is used for schemata which are not materialized
+
+>>> qs = Product.objects.filter(colour='green', size=small)
+>>> qs
+[]
+>>> 'eav_product_flat' in str(qs.query), 'eav_attr' in str(qs.query)
+(True, True)
+
+# rows follow attribute changes
+
+>>> grape = Product.objects.get(title='Grape')
+>>> grape.colour = 'red'
+>>> grape.save()
+>>> Product.objects.filter(colour='red')
+[<Product: Grape>]
+>>> taste.save_attr(grape, 'sweet')
+>>> Product.objects.filter(taste='sweet')
+[<Product: Mango>, <Product: Grape>]
+>>> grape.attrs.get(schema=colour).delete()
+>>> Product.objects.filter(colour='red')
+[]
+>>> Product.objects.bulk_create_with_attrs([{'title': 'Plum', 'colour': 'red'}])
+1
+>>> Product.objects.filter(colour='red')
+[<Product: Plum>]
+
+# sorting uses the flat table, too
+
+>>> Schema.objects.filter(name='colour').update(sortable=True)
+1
+>>> registry.invalidate()
+>>> class ProductFacetSet(BaseFacetSet):
+...     def get_queryset(self, **kwargs):
+...         return Product.objects.filter(**kwargs)
+>>> [x.colour for x in ProductFacetSet({'order_by': 'colour'})]
+[u'black', u'red', None, None]
+>>> [x.colour for x in ProductFacetSet({'order_by': 'colour', 'order_desc': True})]
+[u'red', u'black', None, None]
+>>> paginator = KeysetPaginator(ProductFacetSet({'order_by': 'colour'}), 2)
+>>> page = paginator.page()
+>>> [x.colour for x in page], [x.colour for x in paginator.page(page.next_cursor)]
+([u'black', u'red'], [None, None])
+>>> ProductFacetSet.sort_nulls = 'first'
+>>> paginator = KeysetPaginator(ProductFacetSet({'order_by': 'colour'}), 3)
+>>> page = paginator.page()
+>>> [x.colour for x in page], [x.colour for x in paginator.page(page.next_cursor)]
+([None, None, u'black'], [u'red'])
+>>> paginator = KeysetPaginator(ProductFacetSet({'order_by': 'colour'}), 1)
+>>> page = paginator.page(paginator.page().next_cursor)
+>>> [x.colour for x in page], [x.colour for x in paginator.page(page.next_cursor)]
+([None], [u'black'])
+>>> ProductFacetSet.sort_nulls = 'last'
+>>> Product.objects.get(title='Plum').delete()
+>>> Product.objects.filter(colour='red')
+[]
+>>> call_command('rebuild_flat_tables', 'eav.Product')
+Product: flat table rebuilt.
+>>> Product.objects.filter(colour='black')
+[<Product: Banana>]
+>>> settings.DEBUG = False
+
+##
+## narrow value tables
+##
+
+# values of some datatypes can be stored in narrow tables without empty
+# columns; other values are still stored in the attributes table
+
+>>> weight = NarrowSchema.objects.create(title='Weight', datatype='float', filtered=True)
+>>> screen = NarrowSchema.objects.create(title='Screen', datatype='range')
+>>> maker = NarrowSchema.objects.create(title='Maker', datatype='text')
+>>> NarrowSchema.get_value_models()
+[<class 'eav.tests.NarrowBoolean'>, <class 'eav.tests.NarrowFloat'>, <class 'eav.tests.NarrowRange'>]
+>>> phone = Device.objects.create(title='Phone', weight=0.2, screen=(4, 6), maker='Acme')
+>>> tablet = Device.objects.create(title='Tablet', weight=0.5, maker='Acme')
+>>> NarrowFloat.objects.count(), NarrowRange.objects.count(), NarrowAttr.objects.count()
+(2, 1, 2)
+>>> NarrowFloat.objects.get(entity_id=phone.pk)
+<NarrowFloat: Phone: Weight "0.2">
+>>> phone = Device.objects.get(title='Phone')
+>>> phone.weight, phone.screen, phone.maker
+(0.2, (4.0, 6.0), u'Acme')
+>>> [(x.schema.name, x.value) for x in phone]
+[(u'maker', u'Acme'), (u'weight', 0.2), (u'screen', (4.0, 6.0))]
+
+# lookups use the narrow tables
+
+>>> Device.objects.filter(weight__lt=0.3)
+[<Device: Phone>]
+>>> Device.objects.filter(screen__overlaps=(5, None), maker='Acme')
+[<Device: Phone>]
+>>> Device.objects.exclude(weight=0.2)
+[<Device: Tablet>]
+>>> 'eav_narrowfloat' in str(Device.objects.filter(weight=0.2).query)
+True
+
+# attributes of all entities are loaded with one query per table
+
+>>> settings.DEBUG = True
+>>> reset_queries()
+>>> [(x.title, x.weight, x.screen) for x in Device.objects.with_attrs()]
+[(u'Phone', 0.2, (4.0, 6.0)), (u'Tablet', 0.5, None)]
+>>> len(connection.queries)    # entities, attributes, booleans, floats, ranges
+5
+>>> settings.DEBUG = False
+
+# existing values are updated in place; empty values delete rows
+
+>>> weight.save_attr(phone, 0.25)
+>>> NarrowFloat.objects.values_list('entity_id', 'value_float')
+[(1, 0.25), (2, 0.5)]
+>>> phone.screen = None
+>>> phone.save()
+>>> NarrowRange.objects.count(), Device.objects.get(title='Phone').screen
+(0, None)
+>>> settings.DEBUG = True
+>>> reset_queries()
+>>> charged = NarrowSchema.objects.create(title='Charged', datatype='bool')
+>>> len(connection.queries)    # schema, search index (no flat tables)
+2
+>>> settings.DEBUG = False
+>>> tablet = Device.objects.get(title='Tablet')
+>>> tablet.charged = False
+>>> tablet.save()
+>>> NarrowBoolean.objects.values_list('entity_id', 'value_bool')
+[(2, False)]
+>>> tablet.charged = None
+>>> tablet.weight = None
+>>> tablet.save()
+>>> NarrowBoolean.objects.count(), NarrowFloat.objects.values_list('entity_id', flat=True)
+(0, [1])
+>>> tablet = Device.objects.get(title='Tablet')
+>>> tablet.charged, tablet.weight
+(None, None)
+>>> charged.delete()
+>>> tablet.delete()
+>>> NarrowFloat.objects.count(), NarrowAttr.objects.count()
+(1, 1)
+
+##
+## full-text search
+##
+
+# words of searched text attributes are kept in an inverted index which is
+# updated along with attributes
+
+>>> Device.objects.search('acme')
+[]
+>>> maker.searched = True
+>>> maker.save()
+>>> Device.objects.search('ACME')
+[<Device: Phone>]
+>>> laptop = Device.objects.create(title='Laptop', maker='Acme Computers', weight=2)
+>>> Device.objects.search('computers acme')
+[<Device: Laptop>]
+>>> Device.objects.search('acme').filter(EavQ(weight__gt=1))
+[<Device: Laptop>]
+>>> Device.objects.filter(weight__lt=1).search('acme')
+[<Device: Phone>]
+>>> 'eav_device_search' in str(Device.objects.search('acme').query)
+True
+>>> laptop.maker = 'Initech'
+>>> laptop.save()
+>>> Device.objects.search('computers'), Device.objects.search('initech')
+([], [<Device: Laptop>])
+>>> Device.objects.search(' ').count()
+2
+>>> maker.searched = False
+>>> maker.save()
+>>> Device.objects.search('initech')
+[]
+>>> maker.searched = True
+>>> maker.save()
+>>> Device.objects.search('initech')
+[<Device: Laptop>]
+>>> call_command('rebuild_search_index', 'eav.Device')
+Device: search index rebuilt.
+>>> Device.objects.search('acme')
+[<Device: Phone>]
+
+# models without the index are searched with icontains lookups
+
+>>> Schema.objects.filter(name='taste').update(searched=True)
+1
+>>> registry.invalidate()
+>>> Entity.objects.search('swee')
+[<Entity: Apple>, <Entity: Orange>, <Entity: Tangerine>]
+>>> Entity.objects.search('itte')
+[<Entity: Old Dog>]
+
+# facet sets can take search queries from request data
+
+>>> FacetSet({'q': 'bitter'}).object_list.count()
+8
+>>> class SearchFacetSet(FacetSet):
+...     search_param = 'q'
+>>> SearchFacetSet({'q': 'bitter'}).object_list
+[<Entity: Old Dog>]
+
+##
+## instrumentation
+##
+
+# queries and time are attributed to the outermost EAV operation
+
+>>> from eav.instrumentation import collect_stats
+>>> with collect_stats() as stats:
+...     apple = Entity.objects.get(title='Apple')
+...     colour = apple.colour
+...     taste.save_attr(apple, 'sweet')
+...     fruits = list(Entity.objects.filter(colour='yellow'))
+>>> print stats.summary()
+attribute reads: 1 queries, ... ms
+attribute saves: ... queries, ... ms
+attribute lookups: 1 queries, ... ms
+>>> stats.operations['attr_read']['calls'], stats.queries >= 4
+(1, True)
+
+# queries of querysets filtered by attributes are attributed to lookups, but
+# attributes read while iterating over the results are not
+
+>>> with collect_stats() as stats:
+...     count = Entity.objects.filter(colour='yellow', title='Apple').count()
+...     colours = [x.colour for x in Entity.objects.exclude(taste='sweet')]
+...     prices = list(Entity.objects.filter(price=None))
+>>> stats.operations['lookup']['queries'], len(colours), stats.queries
+(2, 5, 8)
+>>> apple.colour
+u'yellow'
+
+# the middleware collects statistics per request and sends them with a signal
+
+>>> from eav.instrumentation import EavStatsMiddleware, stats_collected
+>>> def on_stats(sender, stats, request, **kwargs):
+...     print sorted(stats.operations)
+>>> stats_collected.connect(on_stats)
+>>> middleware = EavStatsMiddleware()
+>>> request = HttpRequest()
+>>> middleware.process_request(request)
+>>> Entity.objects.get(title='Apple').colour
+u'yellow'
+>>> response = middleware.process_response(request, 'response')
+['attr_read']
+>>> request.eav_stats.operations['attr_read']['queries']
+1
+>>> stats_collected.disconnect(on_stats)
+>>> apple.colour
+u'yellow'
+
+##
+## indexes
+##
+
+# declared composite indexes are created on syncdb; the advisor compares them
+# with the schemata and the data
+
+>>> from eav.indexes import create_value_indexes, get_index_advice
+>>> [(x.datatype, x.status) for x in get_index_advice(Attr, min_rows=1)]
+[('bool', 'not needed'), ('date', 'not needed'), ('float', 'unused'), ('many', 'ok'), ('range', 'missing'), ('text', 'missing')]
+>>> [x.status for x in get_index_advice(Attr)]
+['not needed', 'not needed', 'unused', 'ok', 'not needed', 'not needed']
+>>> call_command('eav_indexes', 'eav.Attr', min_rows=1)
+eav.Attr:
+    upsert: ok
+    bool: not needed eav_attr_bool_idx (0 filtered or sortable schemata, 0 rows, not declared)
+    date: not needed eav_attr_date_idx (0 filtered or sortable schemata, 0 rows, not declared)
+    float: unused eav_attr_float_idx (0 filtered or sortable schemata, 2 rows)
+    many: ok eav_attr_many_idx (1 filtered or sortable schemata, 7 rows)
+    range: missing eav_attr_range_idx (1 filtered or sortable schemata, 3 rows, not declared)
+    text: missing eav_attr_text_idx (2 filtered or sortable schemata, 14 rows, not declared)
+>>> create_value_indexes(Attr, ['text'])
+['eav_attr_text_idx']
+>>> create_value_indexes(Attr, ['text'])
+[]
+>>> call_command('eav_indexes', 'eav.Attr', create=True)
+
+# narrow tables have the index for their datatype by default
+
+>>> [(x.datatype, x.exists) for x in get_index_advice(NarrowFloat)]
+[('float', True)]
+
+##
+## benchmarks
+##
+
+>>> from eav.benchmarks import compare_reports, run_benchmarks
+>>> report = run_benchmarks(entities=20, schemata=6, choices=3, repeat=1)
+>>> report['results'].keys()
+['create', 'save', 'filter', 'filter_range', 'exclude', 'read_attrs', 'read_attrs_prefetched', 'facet_object_list', 'facet_form', 'sort_by_attribute']
+>>> report['results']['read_attrs_prefetched']['queries']
+2
+>>> Entity.objects.filter(title__startswith='Item ').count()
+20
+>>> [row[0] for row in compare_reports(report, report)][:2]
+['create', 'save']
+>>> settings.DEBUG
+False
 """
 
 # TODO: if schema changes type, drop all attribs?
@@ -229,7 +1172,9 @@ from django.db import models
 
 # this app
 from facets import BaseFacetSet
-from models import BaseAttribute, BaseChoice, BaseEntity, BaseSchema
+from models import (AttrSnapshotField, BaseAttribute, BaseBooleanAttribute,
+                    BaseChoice, BaseEntity,
+                    BaseFloatAttribute, BaseRangeAttribute, BaseSchema)
 
 
 class Schema(BaseSchema):
@@ -244,6 +1189,7 @@ class Attr(BaseAttribute):
     #entity = models.ForeignKey(Entity, related_name='attrs')
     schema = models.ForeignKey(Schema, related_name='attrs')
     choice = models.ForeignKey(Choice, related_name='attrs', null=True)
+    value_indexes = ('float', 'many')
 
 
 class Entity(BaseEntity):
@@ -260,6 +1206,75 @@ class Entity(BaseEntity):
         return self.title
 
 
+class Product(BaseEntity):
+    title = models.CharField(max_length=100)
+    attr_snapshot = AttrSnapshotField()
+    flat_table = True
+    attrs = generic.GenericRelation(Attr, object_id_field='entity_id',
+                                    content_type_field='entity_type')
+
+    @classmethod
+    def get_schemata_for_model(cls):
+        return Schema.objects.all()
+
+    def __unicode__(self):
+        return self.title
+
+
+class Part(BaseEntity):
+    parent = models.ForeignKey(Entity, related_name='parts')
+    title = models.CharField(max_length=100)
+    attrs = generic.GenericRelation(Attr, object_id_field='entity_id',
+                                    content_type_field='entity_type')
+
+    @classmethod
+    def get_schemata_for_model(cls):
+        return Schema.objects.all()
+
+    def __unicode__(self):
+        return self.title
+
+
+class NarrowSchema(BaseSchema):
+    value_relations = {'float': 'float_attrs', 'range': 'range_attrs',
+                       'bool': 'bool_attrs'}
+
+
+class NarrowChoice(BaseChoice):
+    schema = models.ForeignKey(NarrowSchema, related_name='choices')
+
+
+class NarrowAttr(BaseAttribute):
+    schema = models.ForeignKey(NarrowSchema, related_name='attrs')
+    choice = models.ForeignKey(NarrowChoice, related_name='attrs', null=True)
+
+
+class NarrowFloat(BaseFloatAttribute):
+    schema = models.ForeignKey(NarrowSchema, related_name='float_attrs')
+
+
+class NarrowRange(BaseRangeAttribute):
+    schema = models.ForeignKey(NarrowSchema, related_name='range_attrs')
+
+
+class NarrowBoolean(BaseBooleanAttribute):
+    schema = models.ForeignKey(NarrowSchema, related_name='bool_attrs')
+
+
+class Device(BaseEntity):
+    title = models.CharField(max_length=100)
+    search_index = True
+    attrs = generic.GenericRelation(NarrowAttr, object_id_field='entity_id',
+                                    content_type_field='entity_type')
+
+    @classmethod
+    def get_schemata_for_model(cls):
+        return NarrowSchema.objects.all()
+
+    def __unicode__(self):
+        return self.title
+
+
 class FacetSet(BaseFacetSet):
     filterable_fields = ['price']
     sortable_fields = ['price']
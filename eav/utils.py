@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Low-level database helpers used by the EAV machinery.
+"""
+
+# django
+from django.db import connections, router, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import AutoField
+
+
+__all__ = ['bulk_insert', 'upsert_attrs', 'create_single_attr_index',
+           'has_single_attr_index', 'has_index']
+
+
+# fields that identify a single-valued attribute; all others hold the value
+ATTR_KEY_FIELDS = ('entity_type', 'entity_id', 'schema')
+
+# (database alias, table name) --> True if upsert can be used for the table;
+# dropped on syncdb and when the index is created via `eav_indexes`, so
+# other processes only use the new index after a restart
+_upsert_tables = {}
+
+# database alias --> True if the backend supports upsert
+_upsert_backends = {}
+
+
+def get_backend_name(connection):
+    "Returns short name of the database backend, e.g. 'sqlite3'."
+    return connection.settings_dict['ENGINE'].split('.')[-1]
+
+
+def bulk_insert(model, objects, using=None):
+    """
+    Inserts given model instances with a single query. Primary keys are *not*
+    set on the instances and no signals are sent. Usage::
+
+        bulk_insert(Attr, [Attr(...), Attr(...)])
+
+    Uses `Manager.bulk_create()` if it is provided by Django, otherwise the
+    rows are inserted with `cursor.executemany()`.
+    """
+    if not objects:
+        return
+    using = using or router.db_for_write(model)
+    manager = model._default_manager.db_manager(using)
+    if hasattr(manager, 'bulk_create'):
+        manager.bulk_create(objects)
+        return
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields
+              if not isinstance(f, AutoField)]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join(qn(f.column) for f in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    params = [[f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+               for f in fields] for obj in objects]
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+    transaction.commit_unless_managed(using=using)
+
+
+def upsert_attrs(model, attrs, using=None):
+    """
+    Saves given unsaved instances of single-valued attribute model: if an
+    attribute with the same entity and schema already exists, its value is
+    updated, otherwise a new row is inserted. Usage::
+
+        upsert_attrs(Attr, schema.build_attrs(entity, 'green'))
+
+    Only the columns which correspond to the schema's datatype are updated.
+    Narrow attribute models (see `eav.models.BaseValueAttribute`) are
+    supported as well.
+
+    On backends that support ``INSERT ... ON CONFLICT`` (SQLite 3.24+,
+    PostgreSQL 9.5+) all attributes with the same datatype are saved with a
+    single atomic statement. This requires a partial unique index which is
+    created on `syncdb` for new tables and by ``./manage.py eav_indexes
+    --create`` for existing ones (see `create_single_attr_index()`); narrow
+    tables have a plain unique constraint instead. Other backends
+    fall back to an update-or-insert sequence which locks the entity row
+    first if the entity does not have the attribute yet.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    groups = {}
+    for attr in attrs:
+        groups.setdefault(tuple(attr.get_value_field_names()), []).append(attr)
+    if _can_upsert(connection, model):
+        for names, batch in groups.items():
+            _upsert_batch(connection, model, batch, names)
+    else:
+        for names, batch in groups.items():
+            for attr in batch:
+                _update_or_insert(connection, model, attr, names)
+    transaction.commit_unless_managed(using=using)
+
+
+def _has_choice(model):
+    "Returns True if given attribute model stores many-to-one values."
+    return 'choice' in [f.name for f in model._meta.fields]
+
+
+def _get_single_attr_index_name(connection, model):
+    name = '%s_single_uniq' % model._meta.db_table
+    return truncate_name(name, connection.ops.max_name_length())
+
+
+def _supports_upsert(connection):
+    if connection.alias not in _upsert_backends:
+        backend = get_backend_name(connection)
+        if backend == 'sqlite3':
+            from django.db.backends.sqlite3.base import Database
+            supported = Database.sqlite_version_info >= (3, 24)
+        elif backend.startswith('postgresql'):
+            from django.db.backends.postgresql.version import get_version
+            supported = get_version(connection.cursor())[:2] >= (9, 5)
+        else:
+            supported = False
+        _upsert_backends[connection.alias] = supported
+    return _upsert_backends[connection.alias]
+
+
+def has_index(connection, name):
+    "Returns True if an index with given name exists in the database."
+    backend = get_backend_name(connection)
+    if backend == 'sqlite3':
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = %s"
+    elif backend == 'mysql':
+        sql = ('SELECT 1 FROM information_schema.statistics '
+               'WHERE table_schema = DATABASE() AND index_name = %s')
+    else:
+        sql = 'SELECT 1 FROM pg_indexes WHERE indexname = %s'
+    cursor = connection.cursor()
+    cursor.execute(sql, [name])
+    return cursor.fetchone() is not None
+
+
+def _can_upsert(connection, model):
+    key = connection.alias, model._meta.db_table
+    if key not in _upsert_tables:
+        supported = _supports_upsert(connection)
+        if supported and _has_choice(model):
+            index_name = _get_single_attr_index_name(connection, model)
+            supported = has_index(connection, index_name)
+        # otherwise the unique constraint of a narrow table is enough
+        _upsert_tables[key] = supported
+    return _upsert_tables[key]
+
+
+def reset_upsert_cache(**kwargs):
+    "Forgets which tables can be upserted (e.g. after syncdb)."
+    _upsert_tables.clear()
+
+
+def has_single_attr_index(model, using=None):
+    """
+    Returns True if given attribute model has the index created by
+    `create_single_attr_index()`, or None if the backend cannot use it.
+    """
+    connection = connections[using or router.db_for_read(model)]
+    if not _supports_upsert(connection):
+        return None
+    return has_index(connection, _get_single_attr_index_name(connection, model))
+
+
+def create_single_attr_index(model, using=None):
+    """
+    Creates a partial unique index on entity and schema of given attribute
+    model for rows without choice. The index prevents duplicate attributes
+    (the `unique_together` constraint does not because choice is NULL) and
+    makes upserts possible. Returns the name of the index if it was created,
+    or None if it already exists or the backend cannot use it.
+
+    The index is created on `syncdb` for new tables only. Tables created by
+    earlier versions of EAV-Django get it with the `eav_indexes` management
+    command::
+
+        ./manage.py eav_indexes --create
+
+    Until then (and until other running processes are restarted, as they
+    remember that the index is missing) attributes are saved with the slower
+    update-or-insert sequence, which on SQLite does not lock anything. Creating the index
+    fails if the table already has duplicate single-valued attributes; they
+    must be deleted first.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    if not _supports_upsert(connection):
+        return None
+    qn = connection.ops.quote_name
+    opts = model._meta
+    index_name = _get_single_attr_index_name(connection, model)
+    if has_index(connection, index_name):
+        return None
+    sql = 'CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s) WHERE %s IS NULL' % (
+        qn(index_name),
+        qn(opts.db_table),
+        ', '.join(qn(opts.get_field(x).column) for x in ATTR_KEY_FIELDS),
+        qn(opts.get_field('choice').column),
+    )
+    cursor = connection.cursor()
+    cursor.execute(sql)
+    transaction.commit_unless_managed(using=using)
+    _upsert_tables[connection.alias, opts.db_table] = True
+    return index_name
+
+
+def _upsert_batch(connection, model, attrs, value_names):
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+    key_columns = [opts.get_field(x).column for x in ATTR_KEY_FIELDS]
+    value_columns = [opts.get_field(x).column for x in value_names]
+    row_sql = '(%s)' % ', '.join(['%s'] * len(fields))
+    where_sql = ''
+    if _has_choice(model):
+        where_sql = ' WHERE %s IS NULL' % qn(opts.get_field('choice').column)
+    sql = ('INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s)%s '
+           'DO UPDATE SET %s') % (
+        qn(opts.db_table),
+        ', '.join(qn(f.column) for f in fields),
+        ', '.join([row_sql] * len(attrs)),
+        ', '.join(qn(x) for x in key_columns),
+        where_sql,
+        ', '.join('%s = excluded.%s' % (qn(x), qn(x)) for x in value_columns),
+    )
+    params = []
+    for attr in attrs:
+        params.extend(f.get_db_prep_save(f.pre_save(attr, True),
+                                         connection=connection)
+                      for f in fields)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+
+
+def _update_or_insert(connection, model, attr, value_names):
+    manager = model._default_manager.db_manager(connection.alias)
+    lookups = dict((x, getattr(attr, x)) for x in ATTR_KEY_FIELDS)
+    if _has_choice(model):
+        lookups['choice__isnull'] = True
+    qs = manager.filter(**lookups)
+    values = dict((x, getattr(attr, x)) for x in value_names)
+    if qs.update(**values):
+        return
+
+    # the attribute is probably missing; lock the entity to make sure that
+    # no other transaction inserts it meanwhile, then check again
+    if get_backend_name(connection) != 'sqlite3':
+        entity_model = attr.entity_type.model_class()
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1 FROM %s WHERE %s = %%s FOR UPDATE' % (
+            qn(entity_model._meta.db_table),
+            qn(entity_model._meta.pk.column)), [attr.entity_id])
+    if qs.update(**values):
+        return
+    attr.save(force_insert=True, using=connection.alias)
@@ -35,7 +35,8 @@ setup(
 
     # technical info
     version  = '1.3.4',
-    packages = ['eav'],
+    packages = ['eav', 'eav.benchmarks', 'eav.management',
+                'eav.management.commands'],
     requires = ['python (>= 2.5)', 'django (>= 1.1)',
                 'django_autoslug (>= 1.3.9)',
                 'django_view_shortcuts (>= 1.3.5)'],